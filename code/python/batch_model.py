@@ -0,0 +1,229 @@
+# A vectorized NumPy engine for the simulations with the cause ball removed.
+# Once ball A is removed, the scene only contains ball B, four static walls,
+# a kinematic brick moving along its track and the brick's sensor. Instead of
+# stepping one pymunk Space per sample, we advance all samples of run_removed
+# in lockstep as arrays of positions, velocities and brick states.
+
+# Each batch starts from the pymunk snapshot of the shared prefix (see model.removed_prefix),
+# so only the noisy part of the simulation after the collision is done here.
+# Contacts follow chipmunk's treatment of a single contact with an immovable body:
+# positions are integrated first, then approaching contacts are reflected with the
+# combined elasticity and penetration beyond the collision slop is partially corrected.
+
+import numpy as np
+import model
+
+
+# Extract the geometry of the removed-cause world of a trial from a pymunk World
+# All static shapes and the brick must be axis aligned boxes
+def scene(trial):
+	w = model.build_removed(trial)
+	target = w.shapes[w.target_ball]
+
+	walls = []
+	elasticity = []
+	for shape in w.space.shapes:
+		if shape.collision_type == w.collision_types['static']:
+			bb = shape.cache_bb()
+			walls.append([bb.left, bb.bottom, bb.right, bb.top])
+			elasticity.append(shape.elasticity*target.elasticity)
+
+	brick = w.brick['body']
+	if brick.angle != 0:
+		raise Exception('Brick orientation', brick.angle, 'not implemented')
+
+	sensor = w.shapes['brick_sensor'].cache_bb()
+
+	return {
+		'walls': np.array(walls),
+		'wall_elasticity': np.array(elasticity),
+		'brick_size': np.array(brick.size, dtype=float),
+		'brick_vel': np.array(w.brick['vel'])*w.speed,
+		'brick_step': w.brick['step'],
+		'brick_elasticity': w.shapes[brick.name].elasticity*target.elasticity,
+		'sensor': np.array([sensor.left, sensor.bottom, sensor.right, sensor.top]),
+		'radius': target.radius,
+		'ball_size': w.ball_size,
+		'step_size': w.step_size,
+		'step_max': w.step_max,
+		'slop': w.space.collision_slop,
+		'bias_coef': 1 - w.space.collision_bias**w.step_size,
+		'target': w.target_ball,
+		'brick': brick.name,
+	}
+
+
+# Vectorized version of model.sample_gate_start drawing num_samples start times at once
+def sample_gate_starts(brick_noise, trial_num, collision_time, max_time, num_samples):
+	start_time, bnoise = model.gate_start_params(brick_noise, trial_num)
+
+	starts = np.ceil(np.random.normal(loc=start_time, scale=bnoise, size=num_samples))
+	redo = (starts <= collision_time) | (starts >= max_time)
+	while redo.any():
+		starts[redo] = np.ceil(np.random.normal(loc=start_time, scale=bnoise, size=redo.sum()))
+		redo = (starts <= collision_time) | (starts >= max_time)
+
+	return starts
+
+
+# Draw the brick start step of every sample following the condition logic of model.run_removed
+def sample_brick_steps(trial, sc, cond, brick_noise, collision_time, num_samples):
+	max_time = sc['step_max'] + 1
+
+	if cond == 'hypothetical':
+		move = np.random.binomial(1, 0.5, size=num_samples).astype(bool)
+		steps = np.full(num_samples, max_time)
+		steps[move] = sample_gate_starts(brick_noise, trial['trial'], collision_time, max_time, move.sum())
+
+	elif cond == 'counterfactual':
+		if sc['brick_step'] < sc['step_max']:
+			steps = sample_gate_starts(brick_noise, trial['trial'], collision_time, max_time, num_samples)
+		else:
+			steps = np.full(num_samples, sc['brick_step'])
+
+	else:
+		raise Exception("Condition", cond, "not implemented")
+
+	return steps
+
+
+# Resolve contacts between the balls and one box per sample
+# box has shape (4,) or (N, 4) as [left, bottom, right, top], box_vel is the velocity of the box
+def collide_box(sc, pos, vel, box, box_vel, elasticity):
+	box = np.atleast_2d(box)
+	closest = np.clip(pos, box[:, :2], box[:, 2:])
+	delta = pos - closest
+	dist = np.sqrt(np.sum(delta**2, axis=1))
+
+	contact = (dist < sc['radius']) & (dist > 0)
+	if not contact.any():
+		return
+
+	normal = delta[contact]/dist[contact, None]
+	rel_vel = vel[contact] - np.broadcast_to(box_vel, vel.shape)[contact]
+	vn = np.sum(rel_vel*normal, axis=1)
+	vel[contact] -= ((1 + elasticity)*np.minimum(vn, 0))[:, None]*normal
+
+	# positional correction of the penetration beyond the collision slop
+	penetration = sc['radius'] - dist[contact]
+	pos[contact] += (sc['bias_coef']*np.maximum(penetration - sc['slop'], 0))[:, None]*normal
+
+
+# Advance all samples from the snapshot until the end of the clip and return the coarse outcomes
+# brick_steps holds the brick start step of every sample
+# If rotation (the cos and sin of the noise of every sample at every step after the collision,
+# see model.SamplePlan) is given, it is used instead of drawing the noise
+def simulate_batch(sc, snapshot, brick_steps, ball_noise, collision_time, rotation=None):
+	num_samples = len(brick_steps)
+	dt = sc['step_size']
+
+	position, velocity = snapshot['bodies'][sc['target']][:2]
+	pos = np.tile(np.array(position, dtype=float), (num_samples, 1))
+	vel = np.tile(np.array(velocity, dtype=float), (num_samples, 1))
+
+	brick_center = np.array(snapshot['bodies'][sc['brick']][0], dtype=float)
+	brick_pos = np.tile(brick_center, (num_samples, 1))
+	brick_vel = np.zeros((num_samples, 2))
+	half = sc['brick_size']/2
+
+	step = snapshot['step']
+	while step <= sc['step_max']:
+		# perturb the ball's direction of motion
+		if ball_noise != 0 and step > collision_time:
+			if rotation is not None:
+				cos_noise = rotation[0][:, step - collision_time - 1]
+				sin_noise = rotation[1][:, step - collision_time - 1]
+			else:
+				perturb = np.random.normal(loc=0, scale=ball_noise, size=num_samples)*np.pi/180
+				cos_noise = np.cos(perturb)
+				sin_noise = np.sin(perturb)
+			x_vel = vel[:, 0]*cos_noise - vel[:, 1]*sin_noise
+			y_vel = vel[:, 0]*sin_noise + vel[:, 1]*cos_noise
+			vel[:, 0] = x_vel
+			vel[:, 1] = y_vel
+
+		# start the bricks that are due
+		brick_vel[brick_steps == step] = sc['brick_vel']
+
+		# integrate positions
+		pos += vel*dt
+		moving = np.any(brick_vel != 0, axis=1)
+		brick_pos[moving] += brick_vel[moving]*dt
+
+		# bricks stop as soon as they overlap their sensor or a wall
+		brick_box = np.hstack([brick_pos - half, brick_pos + half])
+		for box in np.vstack([sc['sensor'], sc['walls']]):
+			overlap = (brick_box[:, 0] < box[2]) & (brick_box[:, 2] > box[0]) & (brick_box[:, 1] < box[3]) & (brick_box[:, 3] > box[1])
+			brick_vel[moving & overlap] = 0
+
+		# ball contacts with the walls and the brick
+		for box, elasticity in zip(sc['walls'], sc['wall_elasticity']):
+			collide_box(sc, pos, vel, box, 0, elasticity)
+		collide_box(sc, pos, vel, brick_box, brick_vel, sc['brick_elasticity'])
+
+		step += 1
+
+	return (pos[:, 0] <= -sc['ball_size']/2).astype(int)
+
+
+# Batched counterpart of model.run_removed: returns the coarse outcome of num_samples samples
+# If a model.SamplePlan is given, brick start steps and noise are taken from it
+def run_removed_batch(trial, num_samples, ball_noise=1.5, collision_time=0, brick_noise=0,
+	cond='counterfactual', snapshot=None, plan=None):
+
+	sc = scene(trial)
+	if snapshot is None:
+		snapshot = model.removed_prefix(trial, collision_time)
+
+	if plan is not None:
+		return simulate_batch(sc, snapshot, plan.brick_steps, ball_noise, collision_time, rotation=plan.rotation(slice(None)))
+
+	brick_steps = sample_brick_steps(trial, sc, cond, brick_noise, collision_time, num_samples)
+
+	return simulate_batch(sc, snapshot, brick_steps, ball_noise, collision_time)
+
+
+# Report the agreement between the numpy and the pymunk engine on the given trials
+# For every possible brick start step without ball noise, the outcome of both engines
+# is compared directly. With noise, judgements of the two engines are compared
+# for both conditions.
+def engine_agreement(trials, ball_noise=0.9, brick_noise=100, num_samples=1000, seed=1):
+	import pandas as pd
+
+	rows = []
+	for trial in trials:
+		collision_time = model.actual_world(trial)['collision_time']
+		snapshot = model.removed_prefix(trial, collision_time)
+		sc = scene(trial)
+
+		# every brick start step after the collision, plus a brick that never moves
+		brick_steps = np.arange(collision_time + 1, sc['step_max'] + 2)
+		batch_outcomes = simulate_batch(sc, snapshot, brick_steps, 0, collision_time)
+
+		pymunk_outcomes = np.zeros(len(brick_steps), dtype=int)
+		for i, brick_step in enumerate(brick_steps):
+			w = model.build_removed(trial)
+			w.brick['step'] = brick_step
+			events = w.simulate(ball_noise=0, collision_time=collision_time, remove=True, snapshot=snapshot)
+			pymunk_outcomes[i] = events['outcome']['outcome_coarse']
+
+		row = {'trial': trial['trial'], 'start_step_agreement': np.mean(batch_outcomes == pymunk_outcomes)}
+
+		for cond in ['hypothetical', 'counterfactual']:
+			np.random.seed(seed)
+			pymunk_judgement = model.model_judgement(trial, cond, ball_noise=ball_noise, brick_noise=brick_noise,
+				num_samples=num_samples, engine='pymunk')
+			np.random.seed(seed)
+			numpy_judgement = model.model_judgement(trial, cond, ball_noise=ball_noise, brick_noise=brick_noise,
+				num_samples=num_samples, engine='numpy')
+
+			row[cond[:3] + '_pymunk'] = pymunk_judgement
+			row[cond[:3] + '_numpy'] = numpy_judgement
+			row[cond[:3] + '_diff'] = numpy_judgement - pymunk_judgement
+
+		rows.append(row)
+
+	report = pd.DataFrame(rows)
+	print(report.to_string(index=False))
+
+	return report
@@ -0,0 +1,170 @@
+import model
+import fit_model
+import numpy as np
+import json
+import sys
+import time
+import tracemalloc
+
+"""
+Benchmarks of the simulation stack, with stored baselines and reference judgements
+python benchmark.py save [baseline_file]                  run the benchmarks and store them as the baseline
+python benchmark.py compare [baseline_file] [threshold]   fail if throughput fell by more than threshold (default 0.2)
+                                                          or a reference judgement changed
+"""
+
+baseline_file = 'benchmark_baselines.json'
+trial_path = 'trialinfo/hyp_count_trials.json'
+seed = 1
+
+
+# Every benchmark runs a fixed-seed workload and returns the amount of work done and its unit
+# The caches of actual worlds, prefixes and world pools are warm, as in the middle of a grid search
+
+def bench_world_simulate(trials):
+	w = model.build_removed(trials[0])
+	w.simulate(ball_noise=0.9, collision_time=model.actual_world(trials[0])['collision_time'], remove=True)
+	return w.step, 'steps'
+
+
+def bench_run_actual(trials):
+	steps = 0
+	for trial in trials:
+		events = model.run_actual(trial)
+		steps += events['outcome']['step']
+	return steps, 'steps'
+
+
+def bench_run_removed(trials, cond, num_samples=50):
+	collision_time = model.actual_world(trials[0])['collision_time']
+	for _ in range(num_samples):
+		model.run_removed(trials[0], ball_noise=0.9, collision_time=collision_time, brick_noise=100, cond=cond)
+	return num_samples, 'samples'
+
+
+def bench_model_judgement(trials, num_samples):
+	for trial in trials:
+		model.model_judgement(trial, 'hypothetical', ball_noise=0.9, brick_noise=100, num_samples=num_samples)
+	return num_samples*len(trials), 'samples'
+
+
+# Without deduplication, so that every trial and condition of the cell is simulated
+def bench_grid_search_cell(trials, num_samples=20):
+	fit_model.generate_model_predictions(num_samples, 0.9, 100, dedupe=False)
+	return num_samples*len(trials)*len(fit_model.conditions), 'samples'
+
+
+benchmarks = {
+	'world_simulate': bench_world_simulate,
+	'run_actual': bench_run_actual,
+	'run_removed_hypothetical': lambda trials: bench_run_removed(trials, 'hypothetical'),
+	'run_removed_counterfactual': lambda trials: bench_run_removed(trials, 'counterfactual'),
+	'model_judgement_50': lambda trials: bench_model_judgement(trials, 50),
+	'model_judgement_200': lambda trials: bench_model_judgement(trials, 200),
+	'grid_search_cell': bench_grid_search_cell,
+}
+
+
+# Time every benchmark as the best throughput of repeat runs and measure its peak memory in a separate run
+# Every run repeats the workload until it took at least min_seconds, so that short workloads are timed reliably
+# Peak memory is what tracemalloc sees, i.e. python allocations, not those made inside chipmunk
+def run_benchmarks(repeat=3, min_seconds=0.5):
+	trials = model.load_trials(trial_path)[:8]
+	for trial in trials:
+		model.actual_world(trial)
+
+	results = {}
+	for name, bench in benchmarks.items():
+		# warm up the caches
+		np.random.seed(seed)
+		bench(trials)
+
+		throughput = 0
+		for _ in range(repeat):
+			np.random.seed(seed)
+			total_units = 0
+			t_start = time.perf_counter()
+			while time.perf_counter() - t_start < min_seconds:
+				units, unit = bench(trials)
+				total_units += units
+			throughput = max(throughput, total_units/(time.perf_counter() - t_start))
+
+		np.random.seed(seed)
+		tracemalloc.start()
+		bench(trials)
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+
+		results[name] = {'units': units, 'unit': unit, 'throughput': throughput, 'peak_mb': peak/2**20}
+		print('{:<28} {:>10.1f} {}/s {:>8.1f} MB'.format(name, throughput, unit, peak/2**20))
+
+	return results
+
+
+# Judgements under fixed seeds that a change to the simulation must not alter
+# They cover the global random state, sample plans and exact judgements
+def reference_judgements(num_samples=100):
+	trials = model.load_trials(trial_path)[:8]
+
+	judgements = {}
+	for trial in trials:
+		for cond in fit_model.conditions:
+			key = '{}_{}'.format(trial['trial'], cond)
+
+			np.random.seed(seed)
+			judgements[key + '_seeded'] = model.model_judgement(trial, cond, ball_noise=0.9, brick_noise=100, num_samples=num_samples)
+			judgements[key + '_plan'] = model.model_judgement(trial, cond, ball_noise=0.9, brick_noise=100, num_samples=num_samples, rng=seed)
+			judgements[key + '_exact'] = model.model_judgement(trial, cond, ball_noise=0, brick_noise=100)
+
+	return judgements
+
+
+def save_baselines(path=baseline_file, repeat=5):
+	baselines = {'benchmarks': run_benchmarks(repeat=repeat), 'judgements': reference_judgements()}
+	with open(path, 'w') as f:
+		json.dump(baselines, f, indent=1, sort_keys=True)
+
+	return baselines
+
+
+# Compare the current code against the baselines
+# A benchmark fails if its throughput fell by more than threshold (a fraction of the baseline),
+# and any reference judgement that changed fails. Returns the list of failures.
+def compare(path=baseline_file, threshold=0.2, repeat=5):
+	with open(path) as f:
+		baselines = json.load(f)
+
+	failures = []
+
+	results = run_benchmarks(repeat=repeat)
+	for name, result in results.items():
+		if name not in baselines['benchmarks']:
+			continue
+		baseline = baselines['benchmarks'][name]['throughput']
+		change = result['throughput']/baseline - 1
+		print('{:<28} {:>+8.1%}'.format(name, change))
+		if change < -threshold:
+			failures.append('{} throughput fell by {:.1%}'.format(name, -change))
+
+	judgements = reference_judgements()
+	for key, reference in baselines['judgements'].items():
+		if not np.isclose(judgements[key], reference, rtol=0, atol=1e-12):
+			failures.append('judgement {} changed from {} to {}'.format(key, reference, judgements[key]))
+
+	for failure in failures:
+		print('FAIL:', failure)
+
+	return failures
+
+
+if __name__ == '__main__':
+	mode = sys.argv[1] if len(sys.argv) > 1 else 'compare'
+	path = sys.argv[2] if len(sys.argv) > 2 else baseline_file
+
+	if mode == 'save':
+		save_baselines(path)
+	elif mode == 'compare':
+		threshold = float(sys.argv[3]) if len(sys.argv) > 3 else 0.2
+		sys.exit(1 if compare(path, threshold) else 0)
+	else:
+		raise Exception('Mode', mode, 'not implemented')
@@ -1,16 +1,46 @@
 import model
+import render
 import sys
+import os
+from concurrent.futures import ProcessPoolExecutor
 
 """
-Takes in experiment and trial to generate a png of each video frame 
-trial = trial index (remember 0 indexing)
+Takes in experiment and trial to generate a png of each video frame
+trial = trial index (remember 0 indexing), or all to export every trial
+python create_frames.py <trial|all> [png|archive|video] [workers]
+
+Frames are rendered offscreen without a frame rate cap and written on a background thread.
+png writes the frames of a single trial into figures/frames, as the animation used to,
+and the frames of trial i into figures/frames/trial_i when exporting all trials.
+archive writes figures/frames/trial_i.zip, video writes figures/frames/trial_i.mp4 (needs ffmpeg).
 """
 
-trial = int(sys.argv[1])
 experiment = 'trialinfo/hyp_count_trials.json'
+extensions = {'png': '', 'archive': '.zip', 'video': '.mp4'}
+
+
+# Render the actual clip of a trial into path
+def export_trial(tr, path, mode='png'):
+	model.run_actual(tr, renderer=render.OffscreenRenderer(path, mode=mode))
+
+
+def export_index(args):
+	index, path, mode = args
+	export_trial(model.load_trials(experiment)[index], path, mode=mode)
+
+
+if __name__ == '__main__':
+	mode = sys.argv[2] if len(sys.argv) > 2 else 'png'
+	workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+
+	trials = model.load_trials(experiment)
 
-trials = model.load_trials(experiment)
-tr = trials[trial]
+	if sys.argv[1] == 'all':
+		jobs = [(i, 'figures/frames/trial_{}{}'.format(i, extensions[mode]), mode) for i in range(len(trials))]
+		with ProcessPoolExecutor(max_workers=workers) as executor:
+			list(executor.map(export_index, jobs))
 
-# def create(exp, tr):
-model.run_actual(tr, animate = True, save = True)	
+	else:
+		trial = int(sys.argv[1])
+		path = 'figures/frames' if mode == 'png' else 'figures/frames/trial_{}{}'.format(trial, extensions[mode])
+		export_trial(trials[trial], path, mode=mode)
@@ -2,34 +2,341 @@ import model
 import numpy as np
 import pandas as pd
 import time
+import math
+import statistics
+import telemetry
+from concurrent.futures import ProcessPoolExecutor
+
+trial_path = 'trialinfo/hyp_count_trials.json'
+conditions = ['hypothetical', 'counterfactual']
+
+# State of a worker process, set up once by init_worker so that tasks
+# don't pay for loading trials and simulating the actual worlds
+worker_state = {}
+
+# Load the trials and look up the actual world, the shared prefix and the world pool of each trial
+def init_worker(path=trial_path):
+	# Don't consider the practice trials
+	trials = model.load_trials(path)[:8]
+	collision_times = [model.actual_world(tr)['collision_time'] for tr in trials]
+
+	worker_state['trials'] = trials
+	worker_state['collision_times'] = collision_times
+	worker_state['snapshots'] = [model.removed_prefix(tr, ct) for tr, ct in zip(trials, collision_times)]
+	worker_state['pools'] = [model.world_pool(tr, ct) for tr, ct in zip(trials, collision_times)]
+
+
+# Simulate one chunk of samples for one (cell, trial, condition)
+# The global random state is seeded from the task's own SeedSequence, so the
+# result does not depend on which process runs the task or in which order
+# Returns the number of samples that went through and the seconds the task took
+def run_task(task):
+	unoise, bnoise, trial_index, condition, num_samples, seed_seq, options = task
+
+	t_start = time.time()
+	np.random.seed(seed_seq.generate_state(4))
+	count = model.count_went_through(worker_state['trials'][trial_index], condition, worker_state['collision_times'][trial_index],
+		num_samples, ball_noise=unoise, brick_noise=bnoise, snapshot=worker_state['snapshots'][trial_index],
+		pool=worker_state['pools'][trial_index], **options)
+	return count, time.time() - t_start
+
+
+# Generate model predictions for a list of (unoise, bnoise) cells by splitting them into
+# (cell, trial, condition, sample chunk) tasks, spread over a pool of worker processes
+# Each task gets a stream derived from the root seed and its position in the grid,
+# so the output only depends on seed and chunk_size, not on the number of workers.
+# With workers=1 the tasks run serially in this process.
+# With exact=True, cells without ball noise are computed exactly in this process instead
+# With dedupe=True, trials and conditions with the same removed_spec in a cell only get tasks once
+# sampling is the sampling strategy and fidelity the physics preset of every chunk (see model.sampling_strategies, model.fidelities)
+# Every cell is reported with cell_done once its tasks are done, with the seconds its tasks took summed
+# over the workers. Cells are reported in order, as the results come back in the order of the tasks.
+# Returns an array of shape (cells, 8, 2)
+def parallel_predictions(cells, num_samples, workers, seed=None, chunk_size=100, engine='pymunk', early_exit=False, exact=True,
+	dedupe=True, sampling='iid', fidelity='reference'):
+	root = np.random.SeedSequence(seed)
+	num_trials = 8
+	options = {'engine': engine, 'early_exit': early_exit, 'sampling': sampling, 'fidelity': fidelity}
+	predictions = np.zeros((len(cells), num_trials, len(conditions)))
+	duplicates = []
+
+	tasks = []
+	keys = []
+	cell_seconds = np.zeros(len(cells))
+	cell_tasks = np.zeros(len(cells), dtype=int)
+	t_start = time.time()
+	for c, (unoise, bnoise) in enumerate(cells):
+		if exact and unoise == 0:
+			t_cell = time.time()
+			predictions[c] = exact_predictions(bnoise, engine=engine)
+			cell_seconds[c] = time.time() - t_cell
+			continue
+
+		representatives = spec_representatives(unoise, bnoise, dedupe=dedupe)
+		for i in range(num_trials):
+			for k, condition in enumerate(conditions):
+				if tuple(representatives[i, k]) != (i, k):
+					duplicates.append((c, i, k, tuple(representatives[i, k])))
+					continue
+
+				for chunk, start in enumerate(range(0, num_samples, chunk_size)):
+					seed_seq = np.random.SeedSequence(root.entropy, spawn_key=(c, i, k, chunk))
+					tasks.append((unoise, bnoise, i, condition, min(chunk_size, num_samples - start), seed_seq, options))
+					keys.append((c, i, k))
+					cell_tasks[c] += 1
+
+	counts = []
+	next_cell = 0
+	if workers == 1:
+		init_worker()
+		results = map(run_task, tasks)
+	else:
+		executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker)
+		results = executor.map(run_task, tasks, chunksize=max(1, len(tasks)//(4*workers)))
+
+	for count, seconds in results:
+		c = keys[len(counts)][0]
+		counts.append(count)
+		cell_seconds[c] += seconds
+		cell_tasks[c] -= 1
+		if len(counts) % max(1, len(tasks)//20) == 0:
+			print(len(counts), 'out of', len(tasks), 'tasks, ETA: {:.0f} s'.format(telemetry.eta(len(counts), len(tasks), t_start)))
+
+		while next_cell < len(cells) and cell_tasks[next_cell] == 0:
+			cell_done(next_cell, len(cells), cells[next_cell][0], cells[next_cell][1], float(cell_seconds[next_cell]), t_start)
+			next_cell += 1
+
+	# the remaining cells (all of them if there were no tasks) have no tasks left
+	for c in range(next_cell, len(cells)):
+		cell_done(c, len(cells), cells[c][0], cells[c][1], float(cell_seconds[c]), t_start)
+
+	if workers != 1:
+		executor.shutdown()
+
+	for key, count in zip(keys, counts):
+		predictions[key] += count/num_samples
+
+	for c, i, k, (j, l) in duplicates:
+		predictions[c, i, k] = predictions[c, j, l]
+
+	return predictions
+
+
+# For every trial and condition, the (trial, condition) whose judgement it shares (see model.spec_representatives)
+# Every pair is its own representative if dedupe is False
+def spec_representatives(uncertainty_noise, brick_noise, dedupe=True):
+	trials = model.load_trials(trial_path)[:8]
+	if not dedupe:
+		return np.array([[(i, k) for k in range(len(conditions))] for i in range(len(trials))])
+
+	collision_times = [model.actual_world(tr)['collision_time'] for tr in trials]
+	return model.spec_representatives(trials, conditions, collision_times, uncertainty_noise, brick_noise)
+
+
+# Exact model predictions without ball noise, see model.exact_judgement
+def exact_predictions(brick_noise, engine='pymunk'):
+	trials = model.load_trials(trial_path)[:8]
+
+	predictions = np.zeros((len(trials), len(conditions)))
+	for i, tr in enumerate(trials):
+		collision_time = model.actual_world(tr)['collision_time']
+		for k, condition in enumerate(conditions):
+			predictions[i, k] = model.exact_judgement(tr, condition, brick_noise, collision_time, engine=engine)
+
+	return predictions
+
 
 # A procedure to generate model predictions for a given parameter setting
 # Returns the model as a 8x2 np array. Hypotheticals on the left, Counterfactuals on the right
-def generate_model_predictions(num_samples, uncertainty_noise, brick_noise, save=False, save_file='../R/data/model_predictions.csv'):
+# engine ('pymunk', 'numpy' or 'multiplex'), early_exit and exact are passed on to model.model_judgement
+# If workers is given the samples are drawn in parallel with parallel_predictions,
+# seeded from seed instead of the global random state
+# If target_ci is given, every judgement samples adaptively up to max_samples until its
+# interval is at most target_ci wide (see model.model_judgement). The intervals (8x2x2)
+# and the number of samples drawn (8x2) are then returned along with the predictions.
+# With dedupe=True, trials and conditions that simulate the same removed-cause world
+# (see model.removed_spec) are simulated once and share their judgement, only the first draws samples.
+# Pass dedupe=False to draw the same random numbers as before deduplication
+# sampling and fidelity select the sampling strategy and physics preset of the judgements (see model.model_judgement)
+def generate_model_predictions(num_samples, uncertainty_noise, brick_noise, save=False, save_file='../R/data/model_predictions.csv', engine='pymunk',
+	workers=None, seed=None, early_exit=False, exact=True, target_ci=None, max_samples=None, dedupe=True, sampling='iid',
+	fidelity='reference'):
 
-	trials = model.load_trials('trialinfo/hyp_count_trials.json')
+	trials = model.load_trials(trial_path)
 	# Don't consider the practice trials
 	trials = trials[:8]
 
-	predictions = np.zeros((len(trials), 2))
+	if workers is not None:
+		if target_ci is not None:
+			raise Exception('Adaptive sampling is not implemented with workers')
+
+		predictions = parallel_predictions([(uncertainty_noise, brick_noise)], num_samples, workers, seed=seed, engine=engine,
+			early_exit=early_exit, exact=exact, dedupe=dedupe, sampling=sampling, fidelity=fidelity)[0]
 
-	for i in range(len(trials)):
-		tr = trials[i]
+	else:
+		predictions = np.zeros((len(trials), 2))
+		intervals = np.zeros((len(trials), 2, 2))
+		samples_used = np.zeros((len(trials), 2), dtype=int)
+		representatives = spec_representatives(uncertainty_noise, brick_noise, dedupe=dedupe)
 
-		hyp_estimate = model.model_judgement(tr, condition='hypothetical', ball_noise=uncertainty_noise,
-			brick_noise=brick_noise, num_samples=num_samples)
-		cf_estimate = model.model_judgement(tr, condition='counterfactual', ball_noise=uncertainty_noise,
-			brick_noise=brick_noise, num_samples=num_samples)
+		for i in range(len(trials)):
+			for k, condition in enumerate(conditions):
+				j, l = representatives[i, k]
+				if (j, l) != (i, k):
+					predictions[i, k] = predictions[j, l]
+					intervals[i, k] = intervals[j, l]
+					continue
 
-		predictions[i,:] = [hyp_estimate, cf_estimate]
+				result = model.model_judgement(trials[i], condition=condition, ball_noise=uncertainty_noise, brick_noise=brick_noise,
+					num_samples=num_samples, engine=engine, early_exit=early_exit, exact=exact, target_ci=target_ci, max_samples=max_samples,
+					sampling=sampling, fidelity=fidelity)
+
+				if target_ci is not None:
+					predictions[i, k] = result['judgement']
+					intervals[i, k] = result['interval']
+					samples_used[i, k] = result['num_samples']
+				else:
+					predictions[i, k] = result
 
 	if save:
 		df_predictions = pd.DataFrame(data=predictions, columns=['hypothetical', 'counterfactual'])
 		df_predictions.to_csv(save_file)
 
+	if target_ci is not None:
+		return predictions, intervals, samples_used
+
 	return predictions
 
 
+# The variance of judgements under every sampling strategy, estimated from repeats independent
+# judgements of num_samples samples per trial and condition, each from its own seed
+# Prints and returns the variances along with the variance reduction of every strategy against iid
+# sampling, i.e. how many times more iid samples reach the same precision. The total row
+# compares the summed variances, which is what the squared error loss of a prediction sees.
+# Trials and conditions that share their simulations (see spec_representatives) are only run once
+def sampling_variance_report(num_samples=100, uncertainty_noise=0.9, brick_noise=100, repeats=30, seed=0,
+	strategies=model.sampling_strategies, engine='pymunk'):
+	trials = model.load_trials(trial_path)[:8]
+	representatives = spec_representatives(uncertainty_noise, brick_noise)
+
+	rows = []
+	for i, tr in enumerate(trials):
+		for k, condition in enumerate(conditions):
+			if tuple(representatives[i, k]) != (i, k):
+				continue
+
+			row = {'trial': i, 'condition': condition}
+			for strategy in strategies:
+				judgements = [model.model_judgement(tr, condition, ball_noise=uncertainty_noise, brick_noise=brick_noise,
+					num_samples=num_samples, engine=engine, sampling=strategy, rng=np.random.SeedSequence(seed, spawn_key=(i, k, r)))
+					for r in range(repeats)]
+				row['mean_' + strategy] = np.mean(judgements)
+				row['var_' + strategy] = np.var(judgements, ddof=1)
+			rows.append(row)
+
+	df_report = pd.DataFrame(rows)
+	total = {'trial': 'total', 'condition': ''}
+	total.update({'var_' + strategy: df_report['var_' + strategy].sum() for strategy in strategies})
+	df_report = pd.concat([df_report, pd.DataFrame([total])], ignore_index=True)
+
+	for strategy in strategies:
+		with np.errstate(divide='ignore', invalid='ignore'):
+			df_report['reduction_' + strategy] = df_report['var_iid']/df_report['var_' + strategy]
+
+	print(df_report.to_string(index=False, float_format='{:.4g}'.format))
+	return df_report
+
+
+# Control variate judgements (see model.control_variate_judgement) of every trial and condition
+# Prints and returns the correlation of the paired full-fidelity and coarse outcomes, the cost ratio
+# of the two fidelities, the savings against plain sampling and whether the judgement fell back to it
+def control_variate_report(num_samples=100, num_low=800, low_fidelity='draft', uncertainty_noise=0.9, brick_noise=100, seed=0,
+	min_correlation=0.5, engine='pymunk'):
+	trials = model.load_trials(trial_path)[:8]
+	representatives = spec_representatives(uncertainty_noise, brick_noise)
+
+	rows = []
+	for i, tr in enumerate(trials):
+		for k, condition in enumerate(conditions):
+			if tuple(representatives[i, k]) != (i, k):
+				continue
+
+			result = model.control_variate_judgement(tr, condition, ball_noise=uncertainty_noise, brick_noise=brick_noise,
+				num_high=num_samples, num_low=num_low, low_fidelity=low_fidelity, min_correlation=min_correlation, engine=engine,
+				rng=np.random.SeedSequence(seed, spawn_key=(i, k)))
+			rows.append({'trial': i, 'condition': condition, 'judgement': result['judgement'], 'correlation': result['correlation'],
+				'cost_ratio': result['seconds_high']/result['seconds_low'], 'savings': result['savings'], 'fallback': result['fallback']})
+
+	df_report = pd.DataFrame(rows)
+	print(df_report.to_string(index=False, float_format='{:.3g}'.format))
+	return df_report
+
+
+# Compare the outcomes and judgements of physics presets (see model.fidelities) against the reference preset
+# Every trial and condition draws one SamplePlan per seed, which all presets simulate, so the outcomes of
+# a sample can be compared directly. Prints and returns, per preset, the fraction of samples with the
+# same outcome as at the reference, the largest and mean absolute difference in judgements, the seconds
+# per sample, the speedup over the reference and whether all judgements are within tolerance.
+# The fastest preset within tolerance is a candidate for large sweeps.
+# Judgements differ by chance too (when outcomes of a sample differ), so tolerance should allow for that
+# at num_samples samples.
+def fidelity_report(presets=list(model.fidelities), num_samples=100, uncertainty_noise=0.9, brick_noise=100, seed=0,
+	reference='reference', tolerance=0.05, early_exit=False):
+	trials = model.load_trials(trial_path)[:8]
+	collision_times = [model.actual_world(tr)['collision_time'] for tr in trials]
+	names = [reference] + [preset for preset in presets if preset != reference]
+
+	outcomes = {name: [] for name in names}
+	seconds = {name: 0 for name in names}
+	for i, tr in enumerate(trials):
+		for k, condition in enumerate(conditions):
+			rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(i, k)))
+			plan = model.SamplePlan(tr, condition, num_samples, uncertainty_noise, brick_noise, collision_times[i], rng)
+			for name in names:
+				t_start = time.perf_counter()
+				outcomes[name].append(model.sample_outcomes_fidelity(tr, collision_times[i], plan, uncertainty_noise, fidelity=name,
+					early_exit=early_exit))
+				seconds[name] += time.perf_counter() - t_start
+
+	base = np.array(outcomes[reference])
+	rows = []
+	for name in names:
+		result = np.array(outcomes[name])
+		difference = np.abs(result.mean(axis=1) - base.mean(axis=1))
+		rows.append({'fidelity': name, 'agreement': (result == base).mean(), 'max_difference': difference.max(),
+			'mean_difference': difference.mean(), 'seconds_per_sample': seconds[name]/base.size,
+			'speedup': seconds[reference]/seconds[name], 'within_tolerance': difference.max() <= tolerance})
+
+	df_report = pd.DataFrame(rows)
+	print(df_report.to_string(index=False, float_format='{:.4g}'.format))
+	return df_report
+
+
+# Model predictions for every brick noise value in bnoise_range from a single set of
+# simulations per trial and condition (see model.reweighted_judgements)
+# Returns predictions of shape (len(bnoise_range), 8, 2) and the matching effective sample sizes
+# Predictions with an effective sample size below min_ess*num_samples are flagged
+# Without ball noise and with exact=True the exact predictions are returned instead
+def reweighted_predictions(num_samples, uncertainty_noise, bnoise_range, engine='pymunk', early_exit=False, exact=True, min_ess=0.1):
+	trials = model.load_trials(trial_path)[:8]
+
+	if exact and uncertainty_noise == 0:
+		predictions = np.array([exact_predictions(bnoise, engine=engine) for bnoise in bnoise_range])
+		return predictions, np.full(predictions.shape, np.inf)
+
+	predictions = np.zeros((len(bnoise_range), len(trials), len(conditions)))
+	ess = np.zeros(predictions.shape)
+	for i, tr in enumerate(trials):
+		for k, condition in enumerate(conditions):
+			predictions[:, i, k], ess[:, i, k] = model.reweighted_judgements(tr, condition, uncertainty_noise, bnoise_range,
+				num_samples=num_samples, engine=engine, early_exit=early_exit)
+
+			for j in np.where(ess[:, i, k] < min_ess*num_samples)[0]:
+				print('Warning: effective sample size', round(ess[j, i, k], 1), 'for trial', i, condition, 'with brick noise', bnoise_range[j])
+
+	return predictions, ess
+
+
 # Calculate the squared error loss for a given model prediction against
 # the human data
 def calculate_loss(model_predictions, human_data): return np.sum((model_predictions - human_data)**2)
@@ -39,25 +346,76 @@ def calculate_loss(model_predictions, human_data): return np.sum((model_predicti
 # Against a given human data response set.
 # Human data and number of samples is fixed for the full search.
 # Option to save the output search if desired. Defaults to save
-# Prints the progress of the outer loop as well as runtime upon completion
-def grid_search(human_data, num_samples, unoise_range, bnoise_range, save=True, save_file='data/new_file.csv'):
+# Prints the time of every cell with the estimated time left, as well as runtime upon completion
+# If workers is given, all cells are simulated at once over a pool of worker
+# processes (see parallel_predictions), seeded from seed
+# With reweight=True, each ball noise value is simulated once and the predictions for
+# all of bnoise_range are obtained by reweighting (see reweighted_predictions). The output
+# then has an additional min_ess column with the smallest effective sample size of each cell.
+# With target_ci, judgements sample adaptively (see generate_model_predictions) and the output
+# has an additional samples column with the total number of samples used in each cell.
+# If telemetry_file is given, telemetry (see telemetry.py) is enabled for the search and
+# its timings and the cell records are saved to the file as json or csv
+# dedupe, sampling and fidelity are passed on to generate_model_predictions and parallel_predictions
+def grid_search(human_data, num_samples, unoise_range, bnoise_range, save=True, save_file='data/new_file.csv',
+	workers=None, seed=None, engine='pymunk', early_exit=False, exact=True, reweight=False, target_ci=None, max_samples=None,
+	telemetry_file=None, dedupe=True, sampling='iid', fidelity='reference'):
 	# output = np.zeros((len(unoise_range), len(bnoise_range)))
 	# loss_values = []
 	loss_values = np.zeros((len(unoise_range)*len(bnoise_range), 3))
+	min_ess = np.zeros(len(unoise_range)*len(bnoise_range))
+	samples = np.zeros(len(unoise_range)*len(bnoise_range), dtype=int)
+
+	if target_ci is not None and (workers is not None or reweight):
+		raise Exception('Adaptive sampling is not implemented with workers or reweighting')
 
+	was_enabled = telemetry.enabled
+	if telemetry_file is not None:
+		telemetry.reset()
+		telemetry.enable()
+
+	num_cells = len(unoise_range)*len(bnoise_range)
 	t_start = time.time()
-	for i in range(len(unoise_range)):
-		print(i + 1, 'out of', len(unoise_range))
-		unoise = unoise_range[i]
-		for j in range(len(bnoise_range)):
-			bnoise = bnoise_range[j]
+	if workers is not None:
+		cells = [(unoise, bnoise) for unoise in unoise_range for bnoise in bnoise_range]
+		predictions = parallel_predictions(cells, num_samples, workers, seed=seed, engine=engine, early_exit=early_exit, exact=exact,
+			dedupe=dedupe, sampling=sampling, fidelity=fidelity)
+		for row_index, (unoise, bnoise) in enumerate(cells):
+			loss_values[row_index, :] = [unoise, bnoise, calculate_loss(predictions[row_index], human_data)]
 
-			model_predictions = generate_model_predictions(num_samples, unoise, bnoise)
-			loss_val = calculate_loss(model_predictions, human_data)
+	elif reweight:
+		for i in range(len(unoise_range)):
+			unoise = unoise_range[i]
 
-			# output[i,j] = loss_val
-			row_index = i*len(bnoise_range) + j
-			loss_values[row_index, :] = [unoise, bnoise, loss_val]
+			t_row = time.time()
+			predictions, ess = reweighted_predictions(num_samples, unoise, bnoise_range, engine=engine, early_exit=early_exit, exact=exact)
+			for j in range(len(bnoise_range)):
+				row_index = i*len(bnoise_range) + j
+				loss_values[row_index, :] = [unoise, bnoise_range[j], calculate_loss(predictions[j], human_data)]
+				min_ess[row_index] = ess[j].min()
+				cell_done(row_index, num_cells, unoise, bnoise_range[j], (time.time() - t_row)/len(bnoise_range), t_start)
+
+	else:
+		for i in range(len(unoise_range)):
+			unoise = unoise_range[i]
+			for j in range(len(bnoise_range)):
+				bnoise = bnoise_range[j]
+
+				t_cell = time.time()
+				row_index = i*len(bnoise_range) + j
+				if target_ci is not None:
+					model_predictions, _, samples_used = generate_model_predictions(num_samples, unoise, bnoise, engine=engine, early_exit=early_exit,
+						exact=exact, target_ci=target_ci, max_samples=max_samples, dedupe=dedupe,
+						sampling=sampling, fidelity=fidelity)
+					samples[row_index] = samples_used.sum()
+				else:
+					model_predictions = generate_model_predictions(num_samples, unoise, bnoise, engine=engine, early_exit=early_exit, exact=exact,
+						dedupe=dedupe, sampling=sampling, fidelity=fidelity)
+				loss_val = calculate_loss(model_predictions, human_data)
+
+				# output[i,j] = loss_val
+				loss_values[row_index, :] = [unoise, bnoise, loss_val]
+				cell_done(row_index, num_cells, unoise, bnoise, time.time() - t_cell, t_start)
 
 	t_end = time.time()
 	print()
@@ -65,11 +423,224 @@ def grid_search(human_data, num_samples, unoise_range, bnoise_range, save=True,
 	print()
 
 	df_grid_search = pd.DataFrame(data=loss_values, columns=['unoise', 'bnoise', 'loss'])
+	if reweight:
+		df_grid_search['min_ess'] = min_ess
+	if target_ci is not None:
+		df_grid_search['samples'] = samples
 	if save:
 		df_grid_search.to_csv(save_file)
 
+	if telemetry_file is not None:
+		telemetry.report()
+		telemetry.save(telemetry_file)
+		if not was_enabled:
+			telemetry.disable()
+
 	return df_grid_search
 
+
+# Report the time a grid search cell took and the estimated time left
+# With telemetry enabled, the cell is also added to the telemetry records
+def cell_done(row_index, num_cells, unoise, bnoise, seconds, t_start):
+	eta = telemetry.eta(row_index + 1, num_cells, t_start)
+	print('cell', row_index + 1, 'out of', num_cells, '(unoise {}, bnoise {}): {:.1f} s, ETA: {:.0f} s'.format(unoise, bnoise, seconds, eta))
+
+	if telemetry.enabled:
+		telemetry.records.append({'unoise': unoise, 'bnoise': bnoise, 'seconds': seconds, 'eta': eta})
+
+# Standard error of calculate_loss given judgements estimated from num_samples samples each
+# By the delta method, the loss changes by 2*(p - h) per unit of judgement p, and each
+# judgement has the binomial variance p*(1 - p)/num_samples
+# The variance is estimated with p shrunk by adding one success and one failure, (x + 1)/(n + 2), so
+# judgements of exactly 0 or 1 from a few samples don't count as certain
+# Without samples (exact predictions) the standard error is 0
+def loss_standard_error(model_predictions, human_data, num_samples):
+	if num_samples == 0:
+		return 0.0
+
+	shrunk = (model_predictions*num_samples + 1)/(num_samples + 2)
+	variance = shrunk*(1 - shrunk)/num_samples
+	return np.sqrt(np.sum(4*(model_predictions - human_data)**2*variance))
+
+
+# A successive halving search over the same grid as grid_search
+# Every cell starts with initial_samples samples per judgement. After each round, cells whose loss
+# is clearly worse than the best cell's (the lower end of loss -/+ z standard errors above the
+# upper end of the best cell's) are eliminated. If more than the keep fraction of the cells remain,
+# only the best ranked fraction is kept. The survivors then get samples up to growth times as many,
+# until at most min_cells cells are left or max_samples is reached. The last round brings every
+# survivor to max_samples.
+# Samples accumulate over the rounds. Every cell draws from its own generator spawned from seed,
+# so the samples of a cell don't depend on which other cells are still racing.
+# Without ball noise and with exact=True the exact loss is used and the cell never needs samples.
+# The output has the format of grid_search, with the loss at the last round a cell took part in,
+# its standard error and the total number of samples drawn for the cell.
+def racing_search(human_data, unoise_range, bnoise_range, initial_samples=50, max_samples=1000, growth=2, keep=0.5,
+	min_cells=3, z=2, save=True, save_file='data/new_file.csv', seed=None, engine='pymunk', exact=True):
+
+	trials = model.load_trials(trial_path)[:8]
+	collision_times = [model.actual_world(tr)['collision_time'] for tr in trials]
+	snapshots = [model.removed_prefix(tr, ct) for tr, ct in zip(trials, collision_times)]
+	pools = [model.world_pool(tr, ct) if engine == 'pymunk' else None for tr, ct in zip(trials, collision_times)]
+
+	cells = [(unoise, bnoise) for unoise in unoise_range for bnoise in bnoise_range]
+	rngs = [np.random.default_rng(seed_seq) for seed_seq in np.random.SeedSequence(seed).spawn(len(cells))]
+
+	went_through = np.zeros((len(cells), len(trials), len(conditions)))
+	samples = np.zeros(len(cells), dtype=int) # per judgement
+	losses = np.zeros(len(cells))
+	errors = np.zeros(len(cells))
+
+	racing = []
+	for c, (unoise, bnoise) in enumerate(cells):
+		if exact and unoise == 0:
+			losses[c] = calculate_loss(exact_predictions(bnoise, engine=engine), human_data)
+		else:
+			racing.append(c)
+
+	t_start = time.time()
+	target = min(initial_samples, max_samples)
+	round_num = 0
+	while True:
+		round_num += 1
+		for c in racing:
+			unoise, bnoise = cells[c]
+			for i in range(len(trials)):
+				for k, condition in enumerate(conditions):
+					went_through[c, i, k] += model.count_went_through(trials[i], condition, collision_times[i], target - samples[c],
+						ball_noise=unoise, brick_noise=bnoise, engine=engine, snapshot=snapshots[i], pool=pools[i], rng=rngs[c])
+			samples[c] = target
+
+			predictions = went_through[c]/samples[c]
+			losses[c] = calculate_loss(predictions, human_data)
+			errors[c] = loss_standard_error(predictions, human_data, samples[c])
+
+		print('round', round_num, ':', len(racing), 'cells at', target, 'samples, time:', time.time() - t_start)
+
+		if len(racing) <= min_cells or target >= max_samples:
+			break
+
+		# the exact cells take part in the comparison but never need samples
+		contenders = racing + [c for c in range(len(cells)) if exact and cells[c][0] == 0]
+		best = min(contenders, key=lambda c: losses[c] + z*errors[c])
+		bound = losses[best] + z*errors[best]
+		racing = sorted([c for c in racing if losses[c] - z*errors[c] <= bound], key=lambda c: losses[c])
+		racing = racing[:max(min_cells, math.ceil(keep*len(racing)))]
+
+		target = min(growth*target, max_samples)
+		if len(racing) <= min_cells:
+			target = max_samples
+
+	df_search = pd.DataFrame(data=[[unoise, bnoise, losses[c]] for c, (unoise, bnoise) in enumerate(cells)], columns=['unoise', 'bnoise', 'loss'])
+	df_search['loss_se'] = errors
+	df_search['samples'] = samples*len(trials)*len(conditions)
+	if save:
+		df_search.to_csv(save_file)
+
+	return df_search
+
+# Model predictions with common random numbers: the judgement of trial i in condition k is
+# always drawn from the sample plan seeded with (seed, i, k), whatever the parameters.
+# Differences between the predictions of two parameter settings are then due to the
+# parameters, not to fresh random draws.
+def common_predictions(num_samples, uncertainty_noise, brick_noise, seed=0, engine='pymunk', exact=True):
+	trials = model.load_trials(trial_path)[:8]
+
+	predictions = np.zeros((len(trials), len(conditions)))
+	for i, tr in enumerate(trials):
+		for k, condition in enumerate(conditions):
+			predictions[i, k] = model.model_judgement(tr, condition, ball_noise=uncertainty_noise, brick_noise=brick_noise,
+				num_samples=num_samples, engine=engine, exact=exact, rng=np.random.SeedSequence(seed, spawn_key=(i, k)))
+
+	return predictions
+
+
+# Gaussian process regression with a squared exponential kernel on inputs scaled to the unit square
+# The length scale and noise level are chosen from a small grid by marginal likelihood
+class GaussianProcess():
+
+	def __init__(self, x, y, length_scales=[0.05, 0.1, 0.2, 0.4], noise_levels=[1e-4, 1e-2, 1e-1]):
+		self.x = x
+		self.mean = y.mean()
+		self.scale = y.std() if y.std() > 0 else 1
+		self.y = (y - self.mean)/self.scale
+
+		best = -np.inf
+		for length_scale in length_scales:
+			for noise in noise_levels:
+				chol = np.linalg.cholesky(self.kernel(x, x, length_scale) + noise*np.eye(len(x)))
+				alpha = np.linalg.solve(chol.T, np.linalg.solve(chol, self.y))
+				likelihood = -0.5*self.y @ alpha - np.log(np.diag(chol)).sum()
+				if likelihood > best:
+					best = likelihood
+					self.length_scale, self.chol, self.alpha = length_scale, chol, alpha
+
+	def kernel(self, a, b, length_scale):
+		return np.exp(-0.5*np.sum((a[:, None, :] - b[None, :, :])**2, axis=2)/length_scale**2)
+
+	# Posterior mean and standard deviation of the loss at the points x
+	def predict(self, x):
+		k = self.kernel(x, self.x, self.length_scale)
+		mean = k @ self.alpha
+		v = np.linalg.solve(self.chol, k.T)
+		sd = np.sqrt(np.maximum(1 - np.sum(v**2, axis=0), 1e-12))
+		return self.mean + self.scale*mean, self.scale*sd
+
+
+# Minimize the loss over continuous ball noise and brick noise by Bayesian optimization
+# Every evaluation computes the loss of common_predictions at a parameter setting, so all
+# evaluations share their random numbers. After initial_points random settings within bounds,
+# a gaussian process (see GaussianProcess) is fit to the losses so far and the next setting
+# is the candidate with the largest expected improvement over the best posterior mean,
+# until budget evaluations are done.
+# Every evaluation is logged and the log is returned (and saved to log_file if given),
+# along with the evaluated setting with the lowest posterior mean.
+def optimize_parameters(human_data, bounds=[(0, 1.5), (0, 300)], num_samples=200, budget=30, initial_points=8,
+	seed=0, engine='pymunk', exact=True, num_candidates=2000, log_file=None):
+
+	rng = np.random.default_rng(seed)
+	low = np.array([bound[0] for bound in bounds], dtype=float)
+	high = np.array([bound[1] for bound in bounds], dtype=float)
+
+	points = [] # scaled to the unit square
+	log = []
+	t_start = time.time()
+	while len(points) < budget:
+		if len(points) < initial_points:
+			point = rng.random(2)
+		else:
+			gp = GaussianProcess(np.array(points), np.array([entry['loss'] for entry in log]))
+			incumbent = gp.predict(np.array(points))[0].min()
+
+			# random candidates, and candidates close to the best settings so far
+			best_points = np.array(points)[np.argsort([entry['loss'] for entry in log])[:3]]
+			local = best_points[rng.integers(len(best_points), size=num_candidates//2)] + rng.normal(scale=0.05, size=(num_candidates//2, 2))
+			candidates = np.clip(np.vstack([rng.random((num_candidates//2, 2)), local]), 0, 1)
+
+			mean, sd = gp.predict(candidates)
+			improvement = (incumbent - mean)/sd
+			normal = statistics.NormalDist()
+			expected_improvement = sd*(improvement*np.array([normal.cdf(u) for u in improvement]) + np.array([normal.pdf(u) for u in improvement]))
+			point = candidates[np.argmax(expected_improvement)]
+
+		unoise, bnoise = low + point*(high - low)
+		t_eval = time.time()
+		loss = calculate_loss(common_predictions(num_samples, unoise, bnoise, seed=seed, engine=engine, exact=exact), human_data)
+
+		points.append(point)
+		log.append({'evaluation': len(log) + 1, 'unoise': unoise, 'bnoise': bnoise, 'loss': loss, 'seconds': time.time() - t_eval})
+		print('evaluation', len(log), 'out of', budget, '(unoise {:.3f}, bnoise {:.1f}): loss {:.4f}, ETA: {:.0f} s'.format(
+			unoise, bnoise, loss, telemetry.eta(len(log), budget, t_start)))
+
+	df_log = pd.DataFrame(log)
+	if log_file is not None:
+		df_log.to_csv(log_file)
+
+	gp = GaussianProcess(np.array(points), df_log['loss'].values)
+	best = int(np.argmin(gp.predict(np.array(points))[0]))
+
+	return df_log.loc[best, ['unoise', 'bnoise']].to_dict(), df_log
+
 # Procedure to draw a contour graph displaying the loss landscape
 # discovered by a grid search.
 # Takes the output of a grid search, either just produced or reloaded
@@ -100,9 +671,44 @@ def visualize_loss_landscape(grid_search_output):
 # unoise_range = np.arange(0, 1.3, 0.1)
 # bnoise_range = np.arange(0, 275, 25)
 
+# Uncomment to compute the human data from the experiment database instead (see human_data.py),
+# for a subset of participants or for a bootstrap resample of them
+# import human_data
+# responses = human_data.analysis_responses()
+# human_data = responses.means()
+# human_data = responses.select(participant=responses.participants()[::2]).means()
+# human_data = responses.bootstrap(num_boot=1, seed=123)[0]
+
 # Uncomment to run the grid search
 # output = grid_search(human_data, 1000, unoise_range, bnoise_range, save_file='data/grid_search.csv')
 
+# Uncomment to run the grid search over several processes with a reproducible root seed
+# output = grid_search(human_data, 1000, unoise_range, bnoise_range, save_file='data/grid_search.csv', workers=8, seed=123)
+
+# Uncomment to run the grid search from a resumable work queue of cells (see grid_queue.py)
+# Start workers on any number of machines sharing the queue with: python grid_queue.py work data/grid_queue 8
+# import grid_queue
+# keys = grid_queue.add_cells('data/grid_queue', unoise_range, bnoise_range, 1000, seed=123)
+# grid_queue.work('data/grid_queue')
+# output = grid_queue.merge('data/grid_queue', human_data, save_file='data/grid_search.csv', keys=keys)
+
+# Uncomment to run a successive halving search over the same grid
+# output = racing_search(human_data, unoise_range, bnoise_range, save_file='data/racing_search.csv', seed=123)
+
+# Uncomment to fit the parameters continuously by Bayesian optimization with common random numbers
+# best, log = optimize_parameters(human_data, budget=30, seed=123, log_file='data/optimization_log.csv')
+
+# Uncomment to compare the variance of judgements under iid, stratified and Sobol sampling
+# report = sampling_variance_report(num_samples=100, repeats=30, engine='numpy')
+
+# Uncomment to see how much coarse-step samples save as control variates
+# report = control_variate_report(num_samples=100, num_low=800, low_fidelity='draft')
+
+# Uncomment to compare the physics presets against the reference and run a grid search with the fastest one within tolerance
+# report = fidelity_report(num_samples=200)
+# output = grid_search(human_data, 1000, unoise_range, bnoise_range, save_file='data/grid_search_fast.csv',
+# 	fidelity=report[report['within_tolerance']].sort_values('speedup')['fidelity'].iloc[-1])
+
 # Uncomment to load the output of a prior gridsearch
 # output = pd.read_csv('data/grid_search.csv')
 
@@ -114,4 +720,4 @@ def visualize_loss_landscape(grid_search_output):
 # To reproduce results, must load grid_search.csv
 # np.random.seed(123)
 
-# opt_model_predictions = generate_model_predictions(num_samples=1000, uncertainty_noise=0.9, brick_noise=0, save=True, save_file='../R/data/model_predictions_ball_only.csv')
\ No newline at end of file
+# opt_model_predictions = generate_model_predictions(num_samples=1000, uncertainty_noise=0.9, brick_noise=0, dedupe=False, save=True, save_file='../R/data/model_predictions_ball_only.csv')
\ No newline at end of file
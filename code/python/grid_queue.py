@@ -0,0 +1,254 @@
+# A grid search split into cells in an on-disk work queue, so that it can be resumed, extended
+# and spread over several processes and machines sharing a filesystem
+# The queue is a directory:
+#   cells/<key>.json    one file per cell with its parameters and simulation settings
+#   claims/<key>.lock   created exclusively by the worker simulating the cell
+#   results/<key>.json  the predictions of a finished cell, written atomically
+# The key of a cell is a hash of its parameters and settings (number of samples, seed, engine, ...),
+# and every cell is seeded from the queue seed and its key, not from its position in the grid.
+# Adding a wider grid to a queue only adds the new cells, and a cell whose result is present
+# is never simulated again. Results hold the predictions, so merge() computes the loss against
+# any human data and writes the output of fit_model.grid_search.
+#
+# python grid_queue.py work <queue_dir> [processes]        claim and simulate cells until none are left
+# python grid_queue.py status <queue_dir>                  count cells, claims and results
+# python grid_queue.py merge <queue_dir> <save_file>       write the losses against data/hpcf_means.csv
+
+import fit_model
+import numpy as np
+import pandas as pd
+import hashlib
+import json
+import os
+import socket
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Claims older than this many seconds are taken to be from workers that died
+claim_timeout = 6*60*60
+
+
+def cell_key(unoise, bnoise, settings):
+	cell = dict(settings, unoise=float(unoise), bnoise=float(bnoise))
+	return hashlib.sha1(json.dumps(cell, sort_keys=True).encode()).hexdigest()
+
+
+# Write a json file atomically, so that readers never see a partial file
+def write_json(path, data):
+	tmp_file = '{}.{}.{}'.format(path, socket.gethostname(), os.getpid())
+	with open(tmp_file, 'w') as f:
+		json.dump(data, f)
+	os.replace(tmp_file, path)
+
+
+def read_json(path):
+	with open(path) as f:
+		return json.load(f)
+
+
+# Add the cells of a grid to the queue in path, creating it if needed
+# The settings are those of fit_model.generate_model_predictions. Cells that are already in the
+# queue with the same settings are left alone. Returns the keys of the cells of the grid.
+def add_cells(path, unoise_range, bnoise_range, num_samples, seed=0, engine='pymunk', early_exit=False, exact=True,
+	dedupe=True, sampling='iid', fidelity='reference'):
+	for directory in ['cells', 'claims', 'results']:
+		os.makedirs(os.path.join(path, directory), exist_ok=True)
+
+	settings = {'num_samples': num_samples, 'seed': seed, 'engine': engine, 'early_exit': early_exit, 'exact': exact,
+		'dedupe': dedupe, 'sampling': sampling, 'fidelity': fidelity}
+
+	keys = []
+	for unoise in unoise_range:
+		for bnoise in bnoise_range:
+			key = cell_key(unoise, bnoise, settings)
+			cell_file = os.path.join(path, 'cells', key + '.json')
+			if not os.path.exists(cell_file):
+				write_json(cell_file, {'unoise': float(unoise), 'bnoise': float(bnoise), 'settings': settings})
+			keys.append(key)
+
+	return keys
+
+
+# Create the lock file of a claim, which fails if it exists
+def create_lock(lock_file):
+	try:
+		fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+	except FileExistsError:
+		return False
+
+	with os.fdopen(fd, 'w') as f:
+		json.dump(owner(), f)
+	return True
+
+
+def owner():
+	return {'host': socket.gethostname(), 'pid': os.getpid()}
+
+
+# Whether a lock (or break) file exists and is older than claim_timeout
+def is_stale(lock_file):
+	try:
+		return time.time() - os.path.getmtime(lock_file) >= claim_timeout
+	except FileNotFoundError:
+		return False
+
+
+# Create the .break file of a claim, which fails if it exists
+# Breaking takes a moment, so a .break file older than claim_timeout is left by a worker that died
+# while breaking the claim. It is removed and created again, so that the claim can still be broken.
+def create_break(break_file):
+	for _ in range(2):
+		try:
+			os.close(os.open(break_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+			return True
+		except FileExistsError:
+			if not is_stale(break_file):
+				return False
+			try:
+				os.remove(break_file)
+			except FileNotFoundError:
+				pass
+
+	return False
+
+
+# Claim a cell by creating its lock file, which fails if another worker holds it
+# A claim older than claim_timeout is broken and the cell claimed again. Only the worker that
+# creates the .break file of the claim may break it, and it checks again that the claim is stale
+# before removing it, so a claim that another worker just took over is never removed.
+def claim(path, key):
+	lock_file = os.path.join(path, 'claims', key + '.lock')
+	if create_lock(lock_file):
+		return True
+
+	if not is_stale(lock_file):
+		return False
+
+	break_file = lock_file + '.break'
+	if not create_break(break_file):
+		return False
+
+	try:
+		broken = is_stale(lock_file)
+		if broken:
+			os.remove(lock_file)
+	finally:
+		os.remove(break_file)
+
+	return broken and create_lock(lock_file)
+
+
+# Remove the claim of a cell, unless it was broken and taken over by another worker
+def release(path, key):
+	lock_file = os.path.join(path, 'claims', key + '.lock')
+	try:
+		if read_json(lock_file) == owner():
+			os.remove(lock_file)
+	except (FileNotFoundError, ValueError):
+		pass
+
+
+def has_result(path, key):
+	return os.path.exists(os.path.join(path, 'results', key + '.json'))
+
+
+# Simulate a cell and write its result
+def run_cell(path, key):
+	cell = read_json(os.path.join(path, 'cells', key + '.json'))
+	settings = cell['settings']
+
+	# every cell gets its own stream from the queue seed and its key
+	t_start = time.time()
+	predictions = fit_model.generate_model_predictions(settings['num_samples'], cell['unoise'], cell['bnoise'], workers=1,
+		seed=[settings['seed'], int(key[:8], 16)], engine=settings['engine'], early_exit=settings['early_exit'], exact=settings['exact'],
+		dedupe=settings['dedupe'], sampling=settings['sampling'], fidelity=settings['fidelity'])
+
+	result = dict(cell, predictions=predictions.tolist(), seconds=time.time() - t_start, host=socket.gethostname())
+	write_json(os.path.join(path, 'results', key + '.json'), result)
+
+
+# Claim and simulate cells of the queue until every cell has a result or is claimed by another worker
+# Returns the number of cells this worker simulated
+def work(path, worker_index=0):
+	done = 0
+	keys = sorted(name[:-len('.json')] for name in os.listdir(os.path.join(path, 'cells')) if name.endswith('.json'))
+
+	# workers start at different cells to claim fewer cells that another worker just took
+	keys = keys[worker_index % max(1, len(keys)):] + keys[:worker_index % max(1, len(keys))]
+	for key in keys:
+		if has_result(path, key) or not claim(path, key):
+			continue
+
+		try:
+			if not has_result(path, key):
+				run_cell(path, key)
+				done += 1
+				counts = status(path)
+				print('cell', key[:8], 'done,', counts['results'], 'out of', counts['cells'], 'cells in the queue have results')
+		finally:
+			release(path, key)
+
+	return done
+
+
+def work_index(args):
+	return work(*args)
+
+
+# Run work() in several processes on this machine
+def work_parallel(path, processes):
+	with ProcessPoolExecutor(max_workers=processes) as executor:
+		return sum(executor.map(work_index, [(path, index) for index in range(processes)]))
+
+
+# Numbers of cells, claims and results in the queue
+def status(path):
+	return {directory: len([name for name in os.listdir(os.path.join(path, directory)) if name.endswith(extension)])
+		for directory, extension in [('cells', '.json'), ('claims', '.lock'), ('results', '.json')]}
+
+
+# The results of the queue as a data frame with the output of fit_model.grid_search (unoise, bnoise, loss)
+# With keys (as returned by add_cells), only those cells are merged, in their order, and missing
+# results raise an exception. Without keys, all results in the queue (whatever their settings) are
+# merged, sorted by unoise and bnoise.
+def merge(path, human_data, save_file=None, keys=None):
+	results_dir = os.path.join(path, 'results')
+	if keys is None:
+		keys = [name[:-len('.json')] for name in os.listdir(results_dir) if name.endswith('.json')]
+		order = True
+	else:
+		missing = [key for key in keys if not has_result(path, key)]
+		if len(missing) > 0:
+			raise Exception(len(missing), 'of', len(keys), 'cells have no result yet')
+		order = False
+
+	rows = []
+	for key in keys:
+		result = read_json(os.path.join(results_dir, key + '.json'))
+		loss = fit_model.calculate_loss(np.array(result['predictions']), human_data)
+		rows.append([result['unoise'], result['bnoise'], loss])
+
+	df_grid_search = pd.DataFrame(data=rows, columns=['unoise', 'bnoise', 'loss'])
+	if order:
+		df_grid_search = df_grid_search.sort_values(['unoise', 'bnoise']).reset_index(drop=True)
+	if save_file is not None:
+		df_grid_search.to_csv(save_file)
+
+	return df_grid_search
+
+
+if __name__ == '__main__':
+	mode = sys.argv[1]
+	path = sys.argv[2]
+
+	if mode == 'work':
+		processes = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+		print(work(path) if processes == 1 else work_parallel(path, processes), 'cells simulated')
+	elif mode == 'status':
+		print(status(path))
+	elif mode == 'merge':
+		human_data = np.array(pd.read_csv('data/hpcf_means.csv')[['human_hp', 'human_cf']])/100
+		print(merge(path, human_data, save_file=sys.argv[3]))
+	else:
+		raise Exception('Mode', mode, 'not implemented')
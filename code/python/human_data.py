@@ -0,0 +1,208 @@
+# Participant responses from the experiment database
+# Every row of the hypothetical_counterfactual table holds the whole psiTurk session of a participant
+# as a json datastring. load_responses parses the datastrings once, optionally in worker processes,
+# into a table of one row per trial with typed numpy columns, and caches the table in an npz file.
+# The cache is keyed by the sha1 of the database file, so it is rebuilt when the database changes.
+# Responses selects participants and trials and aggregates them into arrays shaped like the human
+# data of fit_model (clips x conditions, ratings / 100), as means or per-participant bootstrap resamples.
+
+import fit_model
+import numpy as np
+import pandas as pd
+import hashlib
+import sqlite3
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+db_path = '../../data/experiments_anonymized.db'
+table = 'hypothetical_counterfactual'
+cache_file = 'cache/responses.npz'
+
+# experiment_1 asked for causal, experiment_2 for counterfactual and experiment_3 for hypothetical judgements
+experiments = {'experiment_1': 'causal', 'experiment_2': 'counterfactual', 'experiment_3': 'hypothetical'}
+condition_names = list(experiments.values())
+
+num_clips = 8
+
+# The columns of the response table and their types
+# condition indexes condition_names, clip is 1 to 8 for the test clips and -1, -2 for the practice
+# clips p1, p2, order is the position of the trial in the session (starting at 1), outcome is 1 if
+# ball B went in, time is the response time in seconds
+columns = {
+	'participant': np.int32,
+	'condition': np.int8,
+	'status': np.int8,
+	'clip': np.int8,
+	'order': np.int16,
+	'outcome': np.int8,
+	'rating': np.float32,
+	'time': np.float32,
+	'replay_times': np.int16,
+}
+
+
+def db_hash(path=db_path):
+	sha = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			sha.update(block)
+	return sha.hexdigest()
+
+
+# The trials of one session as a list of rows in the order of columns
+def parse_session(session):
+	status, codeversion, datastring = session
+	data = json.loads(datastring)
+	participant = int(data['workerId'])
+	condition = condition_names.index(experiments[codeversion])
+
+	rows = []
+	for order, entry in enumerate(data['data'], start=1):
+		trial = entry['trialdata']
+		clip = -int(trial['id'][1:]) if isinstance(trial['id'], str) else int(trial['id'])
+		rows.append((participant, condition, status, clip, order, trial['gate_pass'], trial['response'],
+			trial['time']/1000, trial['replay_times']))
+
+	return rows
+
+
+# Parse the sessions of all participants of the experiments into a dict of column arrays
+def parse_db(path=db_path, workers=1):
+	con = sqlite3.connect(path)
+	query = 'SELECT status, codeversion, datastring FROM {} WHERE codeversion IN ({}) ORDER BY rowid'.format(
+		table, ', '.join('?'*len(experiments)))
+	sessions = con.execute(query, list(experiments)).fetchall()
+	con.close()
+
+	if workers > 1:
+		with ProcessPoolExecutor(max_workers=workers) as executor:
+			parsed = list(executor.map(parse_session, sessions, chunksize=max(1, len(sessions)//(4*workers))))
+	else:
+		parsed = [parse_session(session) for session in sessions]
+
+	rows = [row for session_rows in parsed for row in session_rows]
+	return {name: np.array([row[i] for row in rows], dtype=dtype) for i, (name, dtype) in enumerate(columns.items())}
+
+
+# The response table of the database, from the cache if it was built from the same database
+def load_responses(path=db_path, cache_file=cache_file, workers=1):
+	sha = db_hash(path)
+
+	if cache_file != None and os.path.exists(cache_file):
+		with np.load(cache_file) as data:
+			if str(data['db_hash']) == sha:
+				return Responses({name: data[name] for name in columns})
+
+	table_columns = parse_db(path, workers=workers)
+
+	if cache_file != None:
+		os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+		tmp_file = cache_file + '.' + str(os.getpid())
+		with open(tmp_file, 'wb') as f:
+			np.savez(f, db_hash=sha, **table_columns)
+		os.replace(tmp_file, cache_file)
+
+	return Responses(table_columns)
+
+
+# The responses as the analysis uses them: completed sessions, no practice clips and no participants
+# who were shown more than 10 clips
+def analysis_responses(path=db_path, cache_file=cache_file, workers=1):
+	return load_responses(path, cache_file=cache_file, workers=workers).select(status=[3, 4, 5], practice=False, max_order=10)
+
+
+class Responses():
+
+	def __init__(self, table_columns):
+		self.columns = table_columns
+
+	def __len__(self):
+		return len(self.columns['participant'])
+
+	def __getitem__(self, name):
+		return self.columns[name]
+
+	def participants(self):
+		return np.unique(self.columns['participant'])
+
+	# The responses of the rows where mask is true
+	def subset(self, mask):
+		return Responses({name: values[mask] for name, values in self.columns.items()})
+
+	# Select responses by the values of columns, e.g. select(condition='hypothetical', clip=[1, 2])
+	# A value can be a single value or a list of them, conditions can be given by name
+	# practice=False drops the practice clips and max_order drops every participant who did more trials
+	def select(self, practice=None, max_order=None, **fields):
+		mask = np.ones(len(self), dtype=bool)
+
+		for name, value in fields.items():
+			values = np.atleast_1d(value)
+			if name == 'condition' and values.dtype.kind in 'US':
+				values = [condition_names.index(v) for v in values]
+			mask &= np.isin(self.columns[name], values)
+
+		if practice != None:
+			mask &= (self.columns['clip'] < 0) == practice
+
+		if max_order != None:
+			_, index = np.unique(self.columns['participant'], return_inverse=True)
+			session_length = np.zeros(index.max() + 1 if len(index) else 0, dtype=np.int16)
+			np.maximum.at(session_length, index, self.columns['order'])
+			mask &= session_length[index] <= max_order
+
+		return self.subset(mask)
+
+	# Sum of the ratings and number of responses per participant, clip and condition of fit_model
+	# Both have shape (participants, clips, conditions)
+	def participant_sums(self):
+		participants, index = np.unique(self.columns['participant'], return_inverse=True)
+		sums = np.zeros((len(participants), num_clips, len(fit_model.conditions)))
+		counts = np.zeros_like(sums)
+
+		clip = self.columns['clip']
+		for k, condition in enumerate(fit_model.conditions):
+			rows = (self.columns['condition'] == condition_names.index(condition)) & (clip > 0)
+			np.add.at(sums, (index[rows], clip[rows] - 1, k), self.columns['rating'][rows])
+			np.add.at(counts, (index[rows], clip[rows] - 1, k), 1)
+
+		return sums, counts
+
+	# Mean ratings / 100 per clip and condition, shaped like the human data of fit_model
+	# Clips without responses are nan
+	def means(self):
+		sums, counts = self.participant_sums()
+		with np.errstate(invalid='ignore'):
+			return sums.sum(axis=0)/counts.sum(axis=0)/100
+
+	# Means of num_boot resamples of the participants, shape (num_boot, clips, conditions)
+	# Every resample draws participants with replacement, separately for every condition, so that
+	# all the responses of a participant stay together and every condition keeps its sample size
+	def bootstrap(self, num_boot=1000, seed=0):
+		rng = np.random.default_rng(seed)
+		sums, counts = self.participant_sums()
+		resamples = np.full((num_boot, num_clips, len(fit_model.conditions)), np.nan)
+
+		for k in range(len(fit_model.conditions)):
+			members = np.flatnonzero(counts[:, :, k].sum(axis=1) > 0)
+			if len(members) == 0:
+				continue
+			weights = rng.multinomial(len(members), np.full(len(members), 1/len(members)), size=num_boot)
+			with np.errstate(invalid='ignore'):
+				resamples[:, :, k] = (weights @ sums[members, :, k])/(weights @ counts[members, :, k])/100
+
+		return resamples
+
+	# The table as a data frame with condition names
+	def frame(self):
+		df = pd.DataFrame(self.columns)
+		df['condition'] = pd.Categorical.from_codes(df['condition'], condition_names)
+		return df
+
+
+# The means of the analysis agree with the stored data/hpcf_means.csv
+def test_means(means_file='data/hpcf_means.csv'):
+	stored = np.array(pd.read_csv(means_file)[['human_hp', 'human_cf']])/100
+	means = analysis_responses().means()
+	if not np.allclose(means, stored):
+		raise Exception('Means differ from', means_file, means - stored)
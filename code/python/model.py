@@ -2,24 +2,25 @@
 # for the hypothetical vs counterfactual experiment
 # - Jingren Wang, Summer 2019 
 
-import sys
-import pygame
-from pygame.locals import *
 import pymunk
-import pymunk.pygame_util
 import itertools
 import json
 import numpy as np
 import math
-from pymunk import Vec2d
 import collections #for keeping the order in which dictionaries were created
+import copy
+import hashlib
+import os
 import time
 import random
+import statistics
+import telemetry
 
 # WARNING: Pygame and Pymunk have reverse labeling conventions along the Y axis.
 # For pymunk the top is higher values and for pygame the top is lower values
 # be aware when interpreting coordinates
 
+# Drawing is done by the renderers in render.py, the simulation itself doesn't use pygame
 # Problem with empty pygame window: https://stackoverflow.com/questions/52718921/problems-getting-pygame-to-show-anything-but-a-blank-screen-on-macos-mojave
 # pygame issue: https://github.com/pygame/pygame/issues/555
 
@@ -28,26 +29,80 @@ import random
 # movement times change in accordance with the division
 speed_multiplier = 1
 
+# Version of the physics code. Bump it whenever a change to the simulation changes
+# how worlds unfold, so that actual worlds cached by older code are no longer used
+physics_version = 1
+
+# In-memory and on-disk caches of actual world runs, see actual_world()
+actual_cache = {}
+actual_cache_file = 'cache/actual_worlds.json'
+prefix_cache = {}
+outcome_tables = {}
+world_pools = {}
+
+# Named settings of the physics, chosen per World (see World.__init__) or per call
+# step_factor: every step lasts step_factor/50 seconds and the clip has step_factor times fewer steps
+# substeps: pymunk steps per step, each lasting the step size divided by substeps
+# iterations: iterations of pymunk's contact solver per pymunk step
+# collision_slop: overlap between shapes that pymunk allows without correcting it
+# reference is the physics the model was fit with, fit_model.fidelity_report compares the others to it
+fidelities = {
+	'reference': {'step_factor': 1, 'substeps': 1, 'iterations': 10, 'collision_slop': 0.1},
+	'fine': {'step_factor': 1, 'substeps': 2, 'iterations': 10, 'collision_slop': 0.1},
+	'coarse': {'step_factor': 2, 'substeps': 1, 'iterations': 5, 'collision_slop': 0.5},
+	'fast': {'step_factor': 4, 'substeps': 1, 'iterations': 5, 'collision_slop': 0.5},
+	'draft': {'step_factor': 8, 'substeps': 1, 'iterations': 2, 'collision_slop': 0.5},
+}
+
+
+# The settings of a fidelity given by name, or as a dict of settings that differ from the reference
+def fidelity_settings(fidelity):
+	if isinstance(fidelity, dict):
+		settings = dict(fidelities['reference'])
+		settings.update(fidelity)
+		return settings
+
+	if fidelity not in fidelities:
+		raise Exception('Fidelity', fidelity, 'not implemented')
+
+	return fidelities[fidelity]
+
+
+# A hashable key of the settings of a fidelity, for caches
+def fidelity_key(fidelity):
+	return json.dumps(fidelity_settings(fidelity), sort_keys=True)
+
 
 class World():
 
-	def __init__(self, gate=False, start_step=0, step_max=700/speed_multiplier):
+	# fidelity is the name of a preset in fidelities or a dict of settings (see fidelity_settings)
+	# step_max defaults to the end of the clip in steps of the fidelity
+	def __init__(self, gate=False, start_step=0, step_max=None, fidelity='reference'):
+		self.fidelity = fidelity_settings(fidelity)
+		step_factor = self.fidelity['step_factor']
+
 		self.width = 800
 		self.height = 600
 		self.ball_size = 60
 		self.box_size = (70,70)
 		self.speed = 500*speed_multiplier # scales how fast balls are moving, default = 100
-		self.step_size = 1/50.0
-		self.step_max = step_max # step at which to stop the animation,i.e. max frame numbers
+		self.step_size = step_factor/50.0
+		self.substeps = self.fidelity['substeps']
+		# step at which to stop the animation,i.e. max frame numbers
+		self.step_max = 700/speed_multiplier/step_factor if step_max is None else step_max
 		self.step = start_step # used to record when events happen
 		self.space = pymunk.Space()
+		self.space.iterations = self.fidelity['iterations']
+		self.space.collision_slop = self.fidelity['collision_slop']
 		self.events = {'collisions': [], 'outcome': None} # used to record events
 		# containers for bodies and shapes
 		self.bodies = collections.OrderedDict()  # contain dict of ball names
 		self.shapes = collections.OrderedDict()
-		self.sprites = collections.OrderedDict()
 
 		self.record_outcome = True
+		self.early_exit = False # stop as soon as the outcome is decided, see decided_outcome()
+		self.next_decision_check = 0
+		self.rotation = None # planned noise of the target ball, see SamplePlan
 		self.cause_ball = 'A'
 		self.target_ball = 'B'
 		self.brick = None
@@ -128,33 +183,27 @@ class World():
 		self.brick = {'body': body, 'vel': vel, 'step': np.ceil(step/speed_multiplier)}
 		return body, shape
 
-	def flipy(self, y):
-	    """Small hack to convert chipmunk physics to pygame coordinates"""
-	    return -y+600
-
-	def update_sprite(self,body,sprite,screen):
-		p = body.position
-		p = Vec2d(p.x, self.flipy(p.y))
-		angle_degrees = math.degrees(body.angle)
-		rotated_shape = pygame.transform.rotate(sprite, angle_degrees)
-		offset = Vec2d(rotated_shape.get_size()) / 2.
-		p = p - offset
-		screen.blit(rotated_shape, p)
-
-		# setup collision handlers
-		
+	# setup collision handlers
 	def collision_setup(self):
 		handler_dynamic = self.space.add_collision_handler(self.collision_types['dynamic'], self.collision_types['dynamic'])
-		handler_dynamic.begin = self.collisions
-
 		handler_brick_sensor = self.space.add_collision_handler(self.collision_types['brick'], self.collision_types['brick_sensor'])
-		handler_brick_sensor.begin = self.brick_sensor_col
-
 		handler_brick_wall = self.space.add_collision_handler(self.collision_types['brick'], self.collision_types['static'])
-		handler_brick_wall.begin = self.brick_wall_col
-
 		handler_brick_brick = self.space.add_collision_handler(self.collision_types['brick'], self.collision_types['brick'])
-		handler_brick_brick.begin = self.brick_brick_col
+
+		self.handlers = [(handler_dynamic, self.collisions), (handler_brick_sensor, self.brick_sensor_col),
+			(handler_brick_wall, self.brick_wall_col), (handler_brick_brick, self.brick_brick_col)]
+		self.timed_handlers = None
+		self.time_handlers(telemetry.enabled)
+
+	# Wrap the collision handlers in telemetry timers (see telemetry.timed), or unwrap them
+	# The methods are wrapped before they are handed to pymunk, which passes its own arbiter to them
+	def time_handlers(self, timed):
+		if timed == self.timed_handlers:
+			return
+
+		for handler, callback in self.handlers:
+			handler.begin = telemetry.timed(callback.__name__, callback) if timed else callback
+		self.timed_handlers = timed
 
 	# handle dynamic events
 	def collisions(self,arbiter,space,data):
@@ -184,10 +233,65 @@ class World():
 		b2.velocity = (0,0)
 		return True
 
+	# Check whether the brick can no longer change its velocity, i.e. it will never start
+	# or it has already started and come to rest at its sensor or a wall
+	def brick_settled(self):
+		if self.brick == None or self.brick['step'] > self.step_max:
+			return True
+
+		return self.brick['step'] < self.step and self.brick['body'].velocity.get_length_sqrd() == 0
+
+	# Return the coarse outcome if it can provably no longer change before the end of the clip
+	# and None otherwise. Once the brick is settled, collisions are elastic and noise only
+	# rotates velocities, so ball B can at most travel as fast as if it carried the kinetic
+	# energy of all balls. If that can't carry it across the gate threshold in the steps
+	# that are left (with a ball size margin for contact corrections), the outcome is decided.
+	def decided_outcome(self, ball_noise):
+		if not self.brick_settled():
+			return None
+
+		b = self.bodies[self.target_ball]
+		dynamic = [body for body in self.bodies.values() if body.body_type == pymunk.Body.DYNAMIC]
+		energy = sum([body.mass*body.velocity.get_length_sqrd() for body in dynamic])
+		max_speed = math.sqrt(energy/b.mass)
+
+		remaining_steps = math.floor(self.step_max) + 1 - self.step
+		reach = max_speed*remaining_steps*self.step_size + self.ball_size
+
+		distance = b.position[0] + self.ball_size/2 # distance to the gate threshold
+		if distance - reach > 0:
+			return 0
+		if distance + reach <= 0:
+			return 1
+
+		# Without noise and other balls, a ball that left through the gate and keeps moving
+		# away from all shapes can't come back
+		if ball_noise == 0 and len(dynamic) == 1 and distance <= 0 and b.velocity[0] <= 0:
+			shape = self.shapes[self.target_ball]
+			if all([other.cache_bb().left >= b.position[0] + shape.radius for other in self.space.shapes if other != shape]):
+				return 1
+
+		# Each step, distance and reach change by at most max_speed*step_size,
+		# so skip the checks until one of the conditions above could first be met
+		if max_speed > 0:
+			slack = min(reach - distance, reach + distance)
+			if ball_noise == 0 and len(dynamic) == 1:
+				slack = min(slack, 2*distance)
+			self.next_decision_check = self.step + max(1, math.floor(slack/(2*max_speed*self.step_size)))
+		else:
+			self.next_decision_check = math.inf
+
+		return None
+
 	# A method to check whether to end the simulation and record outcome info
-	def end_clip(self):
-		# If we have passed the max step
-		if self.step > self.step_max:
+	# With early_exit set, the simulation also ends as soon as the outcome is decided
+	def end_clip(self, ball_noise=0):
+		decided = None
+		if self.early_exit and self.next_decision_check <= self.step <= self.step_max and self.record_outcome and self.target_ball in self.bodies:
+			decided = self.decided_outcome(ball_noise)
+
+		# If we have passed the max step or the outcome can no longer change
+		if self.step > self.step_max or decided is not None:
 			if self.target_ball in self.bodies:
 				# if we want to record the outcome
 				if self.record_outcome:
@@ -199,7 +303,9 @@ class World():
 							'step': self.step,
 							'outcome_coarse': 0,
 						}
-					if b.position[0] > -self.ball_size/2:
+					if decided is not None:
+						event['outcome_coarse'] = decided
+					elif b.position[0] > -self.ball_size/2:
 						event['outcome_coarse'] = 0
 					else:
 						event['outcome_coarse'] = 1
@@ -207,98 +313,138 @@ class World():
 					# event['outcome_fine'] = b.position
 					self.events['outcome'] = event
 
-			# quit pygame
-			pygame.display.quit()
 			return True
 		else:
 			return False
 
-	def simulate(self, animate=False, track=True, ball_noise=1.5, collision_time=285, remove=False, save=False):
+	# Advance the world by a single frame and return whether the clip is done
+	# The parts of the step are the methods below, which timed_advance() calls in the same order
+	def advance(self, ball_noise, collision_time):
+		self.noise_step(ball_noise, collision_time)
+		self.start_brick()
+		done = self.end_clip(ball_noise=ball_noise)
+		self.physics_step()
+
+		return done
+
+	# Add noise to the ball if noise is positive
+	# Skip the computation if it is not
+	def noise_step(self, ball_noise, collision_time):
+		if ball_noise != 0:
+			self.apply_noise(obj=self.target_ball,step=collision_time,noise=ball_noise)
+
+	# If there is a brick and we've reached the starting step, move the brick
+	def start_brick(self):
+		if self.brick != None and self.step == self.brick['step']:	
+			body = self.brick['body']
+			body.velocity = [x * self.speed for x in self.brick['vel']]
+
+	# Update the world itself: frame by frame advancement
+	def physics_step(self):
+		self.step_space()
+		self.step += 1
+
+	# Step the physics by one step, in substeps of the fidelity
+	def step_space(self):
+		if self.substeps == 1:
+			self.space.step(self.step_size)
+		else:
+			for _ in range(self.substeps):
+				self.space.step(self.step_size/self.substeps)
+
+	# advance() with every part of the step timed for telemetry
+	# end_clip includes starting the brick, space_step the time spent in the collision handlers
+	def timed_advance(self, ball_noise, collision_time):
+		with telemetry.section('apply_noise'):
+			self.noise_step(ball_noise, collision_time)
+
+		with telemetry.section('end_clip'):
+			self.start_brick()
+			done = self.end_clip(ball_noise=ball_noise)
+
+		with telemetry.section('space_step'):
+			self.physics_step()
+
+		return done
+
+	# Record the step, events and the state of every non-static body
+	# so that other worlds with the same setup can be forked from this point
+	def snapshot(self):
+		state = {}
+		for name, body in self.bodies.items():
+			if body.body_type != pymunk.Body.STATIC:
+				state[name] = (tuple(body.position), tuple(body.velocity), body.angle, body.angular_velocity)
+
+		return {'step': self.step, 'events': copy.deepcopy(self.events), 'bodies': state}
+
+	# Restore a world to a state recorded by snapshot()
+	# The world must contain the same bodies as the world the snapshot was taken from
+	def restore(self, snapshot):
+		for name, (position, velocity, angle, angular_velocity) in snapshot['bodies'].items():
+			body = self.bodies[name]
+			body.position = position
+			body.velocity = velocity
+			body.angle = angle
+			body.angular_velocity = angular_velocity
+
+		self.step = snapshot['step']
+		self.events = copy.deepcopy(snapshot['events'])
+		self.next_decision_check = 0
+
+	# If a snapshot is given the world is forked from it after setup,
+	# and simulation continues from the step at which it was taken
+	# With early_exit=True the simulation stops once the outcome is decided,
+	# and the outcome event records the step it stopped at
+	# A renderer (see render.py) is called to draw every frame. With animate=True
+	# and no renderer given, the world is drawn into a pygame window.
+	def simulate(self, animate=False, track=True, ball_noise=1.5, collision_time=285, remove=False, save=False, snapshot=None,
+		early_exit=False, renderer=None):
 
 		self.collision_setup()
 		if remove:
 			self.remove(self.cause_ball, 0)
 
-		done = False # pointer to say when animation is done
+		if snapshot is not None:
+			self.restore(snapshot)
 
 		# animation setup
-		if animate:
-			pygame.init()
-			clock = pygame.time.Clock()
-			screen = pygame.display.set_mode((self.width, self.height))
-			pygame.display.set_caption("Animation")
-			pic_count = 0 # used for saving images
-
-			for bname in self.bodies:
-				if 'sensor' not in bname:
-					sprite = pygame.image.load('figures/' + bname + '.png')
-					self.sprites[bname] = sprite
+		# pygame is only imported when we animate
+		if animate and renderer == None:
+			import render
+			renderer = render.PygameRenderer(self, track=track, save=save)
+
+		return self.run(ball_noise=ball_noise, collision_time=collision_time, early_exit=early_exit, renderer=renderer)
+
+	# Step a world that has been set up from its current state until the end of the clip
+	# and return the events
+	def run(self, ball_noise=1.5, collision_time=285, early_exit=False, renderer=None):
+
+		self.early_exit = early_exit
+		done = False # pointer to say when animation is done
+
+		start_step = self.step
+		advance = self.timed_advance if telemetry.enabled else self.advance
 
 		while not done:
 			# animation code
-			if animate:
-				# quit conditions
-				for event in pygame.event.get():
-					if event.type==QUIT:
-						pygame.quit()
-						sys.exit(0)
-					elif event.type == KEYDOWN and event.key == K_ESCAPE:
-						pygame.quit()
-						sys.exit(0)
-
-				# draw screen, background and bodies
-				screen.fill((255,255,255)) #background
-
-				# draw red gate
-				pygame.draw.rect(screen, pygame.color.THECOLORS['red'], [0, 150, 20, 300])  # 0, 200, 20 ,200
-
-				# draw sliding track if track == True
-				if track==True:
-					pygame.draw.line(screen, (125, 45, 30), (144, 105), (144, 300), 3)  # left track
-					pygame.draw.line(screen, (125, 45, 30), (156, 105), (156, 300), 3)  # right track
-
-					pygame.draw.circle(screen, (125, 45, 30), (144, 105), 3, 3)  # top-left dot
-					pygame.draw.circle(screen, (125, 45, 30), (156, 105), 3, 3)  # top-right dot
-					pygame.draw.circle(screen, (125, 45, 30), (144, 300), 3, 3)  # bottom-left dot
-					pygame.draw.circle(screen, (125, 45, 30), (156, 300), 3, 3)  # bottom-left dot
-
-				for body in self.bodies:
-					if 'sensor' not in body:
-						self.update_sprite(body = self.bodies.get(body), sprite = self.sprites.get(body),screen = screen)
-
-					# pygame.draw.rect(screen, pygame.color.THECOLORS['red'], [0,200,20,200]) #goal
-					pygame.draw.rect(screen, pygame.color.THECOLORS['black'], [0,0,800,20]) #top wall
-					pygame.draw.rect(screen, pygame.color.THECOLORS['black'], [0,580,800,20]) #bottom wall
-					pygame.draw.rect(screen, pygame.color.THECOLORS['black'], [0,0,20,150])
-					pygame.draw.rect(screen, pygame.color.THECOLORS['black'], [0,450,20,200])
-
-
-				# Update the screen
-				pygame.display.flip()
-				pygame.display.update()
-				clock.tick(100)
-
-				if save:
-					pygame.image.save(screen, 'figures/frames/animation'+'{:03}'.format(pic_count)+'.png')
-					pic_count += 1
-
-			
-			# Add noise to the ball if noise is positive
-			# Skip the computation if it is not
-			if ball_noise != 0:
-				self.apply_noise(obj=self.target_ball,step=collision_time,noise=ball_noise)
-
-			# If there is a brick and we've reached the starting step, move the brick
-			if self.brick != None and self.step == self.brick['step']:	
-				body = self.brick['body']
-				body.velocity = [x * self.speed for x in self.brick['vel']]
-
-			# check completion
-			done = self.end_clip()
-
-			# Update the world itself: frame by frame advancement
-			self.space.step(self.step_size)
-			self.step += 1
+			if renderer != None:
+				renderer.draw(self)
+
+			done = advance(ball_noise=ball_noise, collision_time=collision_time)
+
+		if renderer != None:
+			renderer.close()
+
+		if telemetry.enabled:
+			telemetry.count('samples')
+			telemetry.count('steps', self.step - start_step)
+
+		# After an early exit, draw the noise the remaining steps would have drawn
+		# so that the random state is the same as after a full simulation
+		if ball_noise != 0 and self.rotation is None and self.events['outcome'] != None:
+			remaining_draws = math.floor(self.step_max) + 1 - max(self.events['outcome']['step'], collision_time)
+			if remaining_draws > 0:
+				np.random.normal(loc=0, scale=ball_noise, size=remaining_draws)
 
 		# Double check collisions are in temporal order and return
 		assert all([self.events['collisions'][i]['step'] <= self.events['collisions'][i+1]['step'] for i in range(len(self.events['collisions']) - 1)])
@@ -315,8 +461,6 @@ class World():
 			self.space.remove(self.bodies[obj]) #remove body from space 
 			del self.bodies[obj] #remove body 
 			del self.shapes[obj] #remove shape
-			if obj in self.sprites:
-				del self.sprites[obj] #remove sprite 
 
 	############  apply noise to ball velocity vector ############  
 
@@ -328,6 +472,8 @@ class World():
 	## step := which step do we start applying noise (the removed collision point)
 	## arg noise := standard deviation of the angle of perturbation 
 	## this function is recursive at each advancing step
+	## if the world has a planned rotation (cos and sin of the perturbation at every step
+	## after the collision), it is used instead of drawing the perturbation
 
 	def apply_noise(self,obj,step,noise):
 		if not noise == 0:
@@ -335,10 +481,14 @@ class World():
 			if self.step > step:
 				x_vel = b.velocity[0]
 				y_vel = b.velocity[1]
-				# perturb = self.gaussian_noise()*noise
-				perturb = np.random.normal(loc=0, scale=noise)
-				cos_noise = np.cos(perturb*np.pi/180)
-				sin_noise = np.sin(perturb*np.pi/180)
+				if self.rotation is not None:
+					cos_noise = self.rotation[0][self.step - step - 1]
+					sin_noise = self.rotation[1][self.step - step - 1]
+				else:
+					# perturb = self.gaussian_noise()*noise
+					perturb = np.random.normal(loc=0, scale=noise)
+					cos_noise = np.cos(perturb*np.pi/180)
+					sin_noise = np.sin(perturb*np.pi/180)
 				x_vel_noise = x_vel * cos_noise - y_vel * sin_noise
 				y_vel_noise = x_vel * sin_noise + y_vel * cos_noise
 				b.velocity = x_vel_noise,y_vel_noise
@@ -377,30 +527,137 @@ def load_trials(path):
 
 
 # run actual trial to get step of actual collision and outcome value
-def run_actual(trial, animate=False, save=False):
+# A renderer (see render.py) can be given to draw the clip without animating it in a window
+def run_actual(trial, animate=False, save=False, renderer=None):
 	balls = trial['balls']
 
-	# run the actual world to collect step of collision and outcome
-	w = World()
-	if 'bricks' in trial:
-		for brick in trial['bricks']:
-			w.add_brick(brick['name'], brick['orientation'], brick['position'], brick['velocity'], brick['step'])
-			w.add_sensor(brick['sensor_pos'], 'brick_sensor')
+	with telemetry.section('run_actual'):
+		# run the actual world to collect step of collision and outcome
+		with telemetry.section('world_setup'):
+			w = World()
+			if 'bricks' in trial:
+				for brick in trial['bricks']:
+					w.add_brick(brick['name'], brick['orientation'], brick['position'], brick['velocity'], brick['step'])
+					w.add_sensor(brick['sensor_pos'], 'brick_sensor')
 
-	for ball in balls:
-		 w.add_ball(tuple(ball['position']), tuple(ball['velocity']), w.ball_size, ball['name'])
+			for ball in balls:
+				 w.add_ball(tuple(ball['position']), tuple(ball['velocity']), w.ball_size, ball['name'])
 
-	# return list of events in actual world
-	actual_events = w.simulate(animate=animate,track=True, ball_noise=0, collision_time=0, remove=False, save=save)
+		# return list of events in actual world
+		actual_events = w.simulate(animate=animate,track=True, ball_noise=0, collision_time=0, remove=False, save=save, renderer=renderer)
 
 	return actual_events
 
 
+# Content hash identifying the actual world of a trial under the current physics settings
+def actual_key(trial):
+	w = World()
+	settings = {
+		'trial': trial,
+		'step_size': w.step_size,
+		'step_max': w.step_max,
+		'speed_multiplier': speed_multiplier,
+		'physics_version': physics_version,
+		'pymunk': pymunk.version
+	}
+
+	return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+# Read the on-disk cache of actual worlds
+def load_actual_cache(cache_file=actual_cache_file):
+	if cache_file == None or not os.path.exists(cache_file):
+		return {}
+
+	with open(cache_file) as f:
+		return json.load(f)
+
+
+# Simulate the actual world of a trial, or look it up if it was simulated before
+# Returns the actual events along with the step of the first collision and the actual outcome
+# Entries are kept in memory and in cache_file (None for memory only) so that they survive
+# between runs. They are keyed by actual_key, so changing the trial, the physics settings
+# or physics_version simulates the trial again.
+def actual_world(trial, cache_file=actual_cache_file):
+	key = actual_key(trial)
+
+	if key not in actual_cache:
+		actual_cache.update(load_actual_cache(cache_file))
+
+	if key not in actual_cache:
+		events = run_actual(trial)
+		actual_cache[key] = {
+			'events': events,
+			'collision_time': events['collisions'][0]['step'],
+			'outcome': events['outcome']['outcome_coarse']
+		}
+
+		if cache_file != None:
+			# merge with entries written by other processes and replace the file atomically
+			stored = load_actual_cache(cache_file)
+			stored[key] = actual_cache[key]
+			os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+			tmp_file = cache_file + '.' + str(os.getpid())
+			with open(tmp_file, 'w') as f:
+				json.dump(stored, f)
+			os.replace(tmp_file, cache_file)
+
+	return copy.deepcopy(actual_cache[key])
+
+
+# Clear the caches of actual worlds and prefix snapshots, including the on-disk store
+def clear_actual_cache(cache_file=actual_cache_file):
+	actual_cache.clear()
+	prefix_cache.clear()
+	if cache_file != None and os.path.exists(cache_file):
+		os.remove(cache_file)
+
+
 # Repeatedly sample a gate start time from a gaussian centered around the actual
 # start until we find a sample that is within the range of collision time and 
 # clip length
 def sample_gate_start(brick_noise, trial_num, collision_time, max_time):
 
+	start_time, bnoise = gate_start_params(brick_noise, trial_num)
+	hypothetical_start = np.ceil(np.random.normal(loc=start_time, scale=bnoise))
+
+	while not (hypothetical_start > collision_time and hypothetical_start < max_time):
+		hypothetical_start = np.ceil(np.random.normal(loc=start_time, scale=bnoise))
+
+	return hypothetical_start
+
+
+# The gate start times that sample_gate_start draws, computed by inverse CDF from uniform samples u
+# A gaussian sample x gives the start time ceil(x), which is accepted if x is in (collision_time, max_time - 1].
+# u is mapped into the CDF range of that interval. When the interval lies in the upper tail,
+# it is mirrored around the center so the CDF is evaluated where it is precise.
+def gate_start_quantiles(u, brick_noise, trial_num, collision_time, max_time):
+	start_time, bnoise = gate_start_params(brick_noise, trial_num)
+	low = math.floor(collision_time)
+	high = math.ceil(max_time) - 1
+
+	if bnoise == 0:
+		return np.full(len(u), np.ceil(start_time))
+
+	z_low = (low - start_time)/bnoise
+	z_high = (high - start_time)/bnoise
+	mirror = z_low > 0
+	if mirror:
+		z_low, z_high = -z_high, -z_low
+
+	normal = statistics.NormalDist()
+	p_low = 0.5*math.erfc(-z_low/math.sqrt(2))
+	p_high = 0.5*math.erfc(-z_high/math.sqrt(2))
+	z = np.array([normal.inv_cdf(min(max(p, 1e-300), 1 - 1e-16)) for p in p_low + np.asarray(u)*(p_high - p_low)])
+	if mirror:
+		z = -z
+
+	return np.clip(np.ceil(start_time + bnoise*z), low + 1, high)
+
+
+# Center and spread of the gaussian that gate start times are drawn from
+def gate_start_params(brick_noise, trial_num):
+
 	# In trials 0 and 2 the gate starts moving at step 280.
 	# In trials 4 and 6 the gate starts moving at step 290.
 	# For hypothetical simulations we center the gaussian generating start points for
@@ -416,54 +673,252 @@ def sample_gate_start(brick_noise, trial_num, collision_time, max_time):
 	start_time = start_time/speed_multiplier
 
 	bnoise = brick_noise/speed_multiplier
-	hypothetical_start = np.ceil(np.random.normal(loc=start_time, scale=bnoise))
 
-	if hypothetical_start > collision_time and hypothetical_start < max_time:
-		return hypothetical_start
+	return start_time, bnoise
 
-	else:
-		return sample_gate_start(brick_noise, trial_num, collision_time, max_time)
 
+# The exact distribution of the start times drawn by sample_gate_start
+# A start time k is drawn when the gaussian sample falls in (k-1, k], and only
+# steps after collision_time and before max_time are accepted
+# Returns the candidate steps and their probabilities
+def gate_start_distribution(brick_noise, trial_num, collision_time, max_time):
+	start_time, bnoise = gate_start_params(brick_noise, trial_num)
+	steps = np.arange(math.floor(collision_time) + 1, math.ceil(max_time))
 
+	if bnoise == 0:
+		probs = (steps == np.ceil(start_time)).astype(float)
+	else:
+		cdf = np.array([0.5*(1 + math.erf((k - start_time)/(bnoise*math.sqrt(2)))) for k in range(steps[0] - 1, steps[-1] + 1)])
+		probs = np.diff(cdf)
 
-# simulate ball B after ball A being removed for both cf and hp conditions
+	return steps, probs/probs.sum()
 
-# There are two differing conditions in this experiment where we will want to do simulations with
-# a removed cause ball
 
-# In the counterfactual condition, we simulate as in other experiments.
-# We remove the candidate cause and then apply noise to the movement of any ball that collided
-# with the candidate, to represent the thinker's uncertainty in how the other ball would have
-# moved after the collision.
-# We model uncertainty as to exactly when the brick moves in the scenarios where the brick
-# actually moves. In scenarios where the brick does not move, the model is certain that the
-# brick would not have moved in the counterfactual.
-
-# In the hypothetical condition, we simulate noise for the ball in the
-# same way as we do in the counterfactual condition.
-# Additionally, because the thinker did not view the gate's movement,
-# we simulate uncertainty as to whether and when the gate will move. 
-def run_removed(trial, animate=False, track=False, ball_noise=1.5, collision_time=0,
-	brick_noise=0, cond='counterfactual', save=False, testing_output=False):       
-
-	# world setup
-	w = World()
-	
-	# args setup
-	trial_num = trial['trial']
-	balls = trial['balls']
+# Build the world used for simulations with the cause removed: both balls, the brick and its sensor
+# The cause ball is removed at the start of the simulation
+# The world has the physics of fidelity (see fidelities)
+def build_removed(trial, fidelity='reference'):
+	w = World(fidelity=fidelity)
 
 	# add ball A and ball B
-	for ball in balls:
+	for ball in trial['balls']:
 		 w.add_ball(tuple(ball['position']), tuple(ball['velocity']), w.ball_size, ball['name'])
 
-
 	for brick in trial['bricks']:
 		w.add_brick(brick['name'], brick['orientation'], brick['position'], brick['velocity'], brick['step'])
 		w.add_sensor(brick['sensor_pos'], 'brick_sensor')
 
+	return w
+
+
+# Simulate the part of a removed-cause world that is shared by all samples of a trial
+# Nothing random happens up to and including collision_time: noise is only applied after it,
+# and every sampled brick start time is later than it. So we step through that prefix once
+# and return a snapshot that run_removed can fork each sample from.
+# Snapshots are memoized in memory per trial content, collision time and fidelity.
+# collision_time is in steps of the fidelity.
+def removed_prefix(trial, collision_time, fidelity='reference'):
+	key = (actual_key(trial), collision_time, fidelity_key(fidelity))
+	if key in prefix_cache:
+		return prefix_cache[key]
+
+	w = build_removed(trial, fidelity=fidelity)
+	w.collision_setup()
+	w.remove(w.cause_ball, 0)
+
+	# the brick never starts moving within the prefix
+	w.brick['step'] = w.step_max + 1
+
+	while w.step <= collision_time:
+		w.advance(ball_noise=0, collision_time=collision_time)
+
+	prefix_cache[key] = w.snapshot()
+	return prefix_cache[key]
+
+
+# A removed-cause world of a trial that is built once and reused for every sample
+# The world is set up with the cause already removed and the collision handlers registered.
+# The world is only handed out by acquire(), which resets the step, the events, the brick and
+# the planned rotation, and replaces the moving bodies by fresh ones in the state at the end of the shared prefix.
+# Fresh bodies carry no contact or solver state over from the previous sample, so no state
+# can leak from one sample into the next. The space, walls, sensor and handlers are reused,
+# and acquire() times the handlers whenever telemetry is enabled (see World.time_handlers).
+# The world has the physics of fidelity (see fidelities)
+class WorldPool():
+
+	def __init__(self, trial, collision_time, fidelity='reference'):
+		self.trial = trial
+		self.snapshot = removed_prefix(trial, collision_time, fidelity=fidelity)
+
+		self.world = build_removed(trial, fidelity=fidelity)
+		self.world.collision_setup()
+		self.world.remove(self.world.cause_ball, 0)
+
+	# Reset the world and return it for a single sample
+	def acquire(self):
+		w = self.world
+
+		for name in self.snapshot['bodies']:
+			w.space.remove(w.bodies[name], w.shapes[name])
+
+		for ball in self.trial['balls']:
+			if ball['name'] in self.snapshot['bodies']:
+				w.add_ball(tuple(ball['position']), tuple(ball['velocity']), w.ball_size, ball['name'])
+
+		for brick in self.trial['bricks']:
+			w.add_brick(brick['name'], brick['orientation'], brick['position'], brick['velocity'], brick['step'])
+
+		w.restore(self.snapshot)
+		w.rotation = None
+		w.time_handlers(telemetry.enabled)
+		return w
+
 
+# The WorldPool of a trial, built on first use
+def world_pool(trial, collision_time, fidelity='reference'):
+	key = (actual_key(trial), collision_time, fidelity_key(fidelity))
+	if key not in world_pools:
+		world_pools[key] = WorldPool(trial, collision_time, fidelity=fidelity)
 
+	return world_pools[key]
+
+
+# A removed-cause world holding several independent copies of a trial in one space
+# Every copy has its own ball B, brick and sensor. The shapes of copy k only collide with
+# collision category k and the walls, which are shared and collide with everything, so the
+# copies never interact and a single space.step advances all of them at once.
+# Each copy has its own brick start step and noise, and its own outcome at the end of the clip.
+class MultiWorld(World):
+
+	# Every copy gets its own collision category, so a space holds at most 32 copies
+	max_copies = 32
+
+	def __init__(self, trial, num_copies):
+		World.__init__(self)
+		if num_copies > self.max_copies:
+			raise Exception('A space holds at most', self.max_copies, 'copies, not', num_copies)
+
+		self.copies = []
+		for k in range(num_copies):
+			shape_filter = pymunk.ShapeFilter(categories=1 << k, mask=1 << k)
+			bodies = {}
+
+			for ball in trial['balls']:
+				if ball['name'] != self.cause_ball:
+					body, shape = self.add_ball(tuple(ball['position']), tuple(ball['velocity']), self.ball_size, '{}_{}'.format(ball['name'], k))
+					shape.filter = shape_filter
+					bodies[ball['name']] = body
+
+			for brick in trial['bricks']:
+				body, shape = self.add_brick('{}_{}'.format(brick['name'], k), brick['orientation'], brick['position'], brick['velocity'], brick['step'])
+				shape.filter = shape_filter
+				bodies[brick['name']] = body
+
+				body, shape = self.add_sensor(brick['sensor_pos'], 'brick_sensor_{}'.format(k))
+				shape.filter = shape_filter
+
+			self.copies.append({'bodies': bodies, 'brick': self.brick})
+
+		self.brick = None
+
+	# Restore every copy to the state of a snapshot of a single removed-cause world
+	def restore(self, snapshot):
+		for replica in self.copies:
+			for name, (position, velocity, angle, angular_velocity) in snapshot['bodies'].items():
+				body = replica['bodies'][name]
+				body.position = position
+				body.velocity = velocity
+				body.angle = angle
+				body.angular_velocity = angular_velocity
+
+		self.step = snapshot['step']
+		self.events = copy.deepcopy(snapshot['events'])
+
+	# Step all copies until the end of the clip and return the coarse outcome of each copy
+	# rotation holds the cos and sin of the perturbation of every copy for the steps after
+	# collision_time (one row per copy), or is None without ball noise
+	def run(self, rotation, collision_time):
+		if rotation is not None:
+			cos_noise, sin_noise = rotation
+
+		balls = [replica['bodies'][self.target_ball] for replica in self.copies]
+		start_step = self.step
+
+		while self.step <= self.step_max:
+			# Add noise to the balls
+			if rotation is not None and self.step > collision_time:
+				i = self.step - collision_time - 1
+				for b, cos_n, sin_n in zip(balls, cos_noise[:, i], sin_noise[:, i]):
+					x_vel = b.velocity[0]
+					y_vel = b.velocity[1]
+					b.velocity = x_vel*cos_n - y_vel*sin_n, x_vel*sin_n + y_vel*cos_n
+
+			# Start the bricks that are due
+			for replica in self.copies:
+				if self.step == replica['brick']['step']:
+					replica['brick']['body'].velocity = [x*self.speed for x in replica['brick']['vel']]
+
+			self.step_space()
+			self.step += 1
+
+		if telemetry.enabled:
+			telemetry.count('samples', len(balls))
+			telemetry.count('steps', len(balls)*(self.step - start_step))
+
+		return np.array([int(b.position[0] <= -self.ball_size/2) for b in balls])
+
+
+# Multiplexed counterpart of run_removed: returns the coarse outcomes of num_samples samples,
+# simulated MultiWorld.max_copies at a time
+# Every sample draws its brick start step and then its noise in the same order as
+# one run_removed call does, so both use the random state in the same way.
+# If brick_steps is given, the samples use these brick start steps instead of drawing them.
+# If a SamplePlan is given, brick start steps and noise are taken from it instead.
+def run_removed_multiplexed(trial, num_samples, ball_noise=1.5, collision_time=0, brick_noise=0,
+	cond='counterfactual', snapshot=None, brick_steps=None, plan=None):
+
+	if snapshot is None:
+		snapshot = removed_prefix(trial, collision_time)
+
+	outcomes = []
+	for start in range(0, num_samples, MultiWorld.max_copies):
+		w = MultiWorld(trial, min(MultiWorld.max_copies, num_samples - start))
+		w.collision_setup()
+
+		# noise is drawn for every step after the collision up to and including step_max + 1
+		num_draws = math.floor(w.step_max) + 1 - collision_time
+		noise = np.zeros((len(w.copies), num_draws))
+
+		if plan is not None:
+			brick_steps = plan.brick_steps
+
+		for k, replica in enumerate(w.copies):
+			if brick_steps is None:
+				replica['brick']['step'] = sample_brick_step(trial, replica['brick']['step'], cond, brick_noise, collision_time, w.step_max)
+			else:
+				replica['brick']['step'] = brick_steps[start + k]
+
+			if replica['brick']['step'] < snapshot['step']:
+				raise Exception('Brick start', replica['brick']['step'], 'falls within the shared prefix')
+
+			if ball_noise != 0 and plan is None:
+				noise[k] = np.random.normal(loc=0, scale=ball_noise, size=num_draws)
+
+		rotation = None
+		if plan is not None:
+			rotation = plan.rotation(slice(start, start + len(w.copies)))
+		elif ball_noise != 0:
+			rotation = (np.cos(noise*np.pi/180), np.sin(noise*np.pi/180))
+
+		w.restore(snapshot)
+		outcomes.append(w.run(rotation, collision_time))
+
+	return np.concatenate(outcomes)
+
+
+# Draw the brick start step of a removed-cause sample given the brick's start step in the actual world
+def sample_brick_step(trial, brick_step, cond, brick_noise, collision_time, step_max):
+	trial_num = trial['trial']
 
 	# If we are in the hypothetical condition, we need to account for the thinker's
 	# uncertainty about if and when the brick would move. We modify the brick's starting
@@ -475,7 +930,7 @@ def run_removed(trial, animate=False, track=False, ball_noise=1.5, collision_tim
 
 		# If the brick will not move, set the brick's movement time to after the clip finishes
 		if not move:
-			w.brick['step'] = w.step_max + 1
+			return step_max + 1
 
 		# If the brick will move draw a random movement start time from a gaussian,
 		# centered around the actual movement start time. Make sure that start time is 
@@ -483,24 +938,246 @@ def run_removed(trial, animate=False, track=False, ball_noise=1.5, collision_tim
 		# This reflects the thinker's uncertainty of when the brick would move given
 		# that it would move
 		else:
-			hypothetical_start = sample_gate_start(brick_noise, trial_num, collision_time, w.step_max + 1)
-			w.brick['step'] = hypothetical_start
+			hypothetical_start = sample_gate_start(brick_noise, trial_num, collision_time, step_max + 1)
+			return hypothetical_start
 
 	elif cond == 'counterfactual':
 		# If we are in the counterfactual condition
 		# check whether the gate moves in the actual world
-		if w.brick['step'] < w.step_max:
+		if brick_step < step_max:
 			# If the gate moves in the actual world, add uncertainty to its start point
 			# in the counterfactual just as we do in the hypothetical setting
-			counterfactual_start = sample_gate_start(brick_noise, trial_num, collision_time, w.step_max + 1)
-			w.brick['step'] = counterfactual_start
+			counterfactual_start = sample_gate_start(brick_noise, trial_num, collision_time, step_max + 1)
+			return counterfactual_start
 
 	else:
 		raise Exception("Condition", cond, "not implemented")
 
+	return brick_step
+
+
+# The effective simulation behind removed-cause samples of a trial in a condition, as a hashable key
+# Samples with the same key are draws from the same distribution, so their judgements can be shared.
+# The trial number only enters through the center and spread of the gate start times (gate_start_params).
+# Of the actual brick start step, what is left after sample_brick_step is nothing in the hypothetical
+# condition, and in the counterfactual condition whether the brick moves, or the step it would move at
+# if it does not move before step_max (only 'still' if it never moves within the clip)
+def removed_spec(trial, condition, collision_time, ball_noise, brick_noise, step_max=700/speed_multiplier):
+	content = copy.deepcopy(trial)
+	del content['trial']
+	for brick in content['bricks']:
+		del brick['step']
+
+	brick_step = np.ceil(trial['bricks'][0]['step']/speed_multiplier)
+	if condition == 'hypothetical' or brick_step < step_max:
+		brick = 'sampled'
+	elif brick_step > step_max:
+		brick = 'still'
+	else:
+		brick = float(brick_step)
+
+	return (json.dumps(content, sort_keys=True), condition, collision_time, ball_noise, gate_start_params(brick_noise, trial['trial']), brick)
+
+
+# For every (trial, condition) pair, the index of the first pair with the same removed_spec
+# Pairs that are their own representative are the only ones that need to be simulated
+def spec_representatives(trials, conditions, collision_times, ball_noise, brick_noise):
+	first = {}
+	representatives = np.zeros((len(trials), len(conditions), 2), dtype=int)
+	for i, trial in enumerate(trials):
+		for k, condition in enumerate(conditions):
+			spec = removed_spec(trial, condition, collision_times[i], ball_noise, brick_noise)
+			representatives[i, k] = first.setdefault(spec, (i, k))
+
+	return representatives
+
+
+# Strategies for drawing the samples of a SamplePlan
+# iid draws every sample independently. stratified splits the hypothetical samples evenly into
+# moving and still bricks, puts one brick start quantile into each of as many equal intervals as
+# there are moving samples, and draws the qmc_dims leading normals of the ball noise (see
+# bridge_perturbations) as a latin hypercube. sobol draws the move flag, the start quantile and
+# the leading normals from one scrambled Sobol sequence (needs scipy).
+# Every sample still has the distribution of an iid sample, so judgements stay unbiased.
+sampling_strategies = ['iid', 'stratified', 'sobol']
+
+
+# Uniforms of shape (n, d) whose every column has one value in each of the intervals [i/n, (i + 1)/n)
+def stratified_uniforms(rng, n, d):
+	strata = rng.permuted(np.tile(np.arange(n), (d, 1)), axis=1).T
+	return (strata + rng.random((n, d)))/n
+
+
+# Uniforms of shape (n, d): the first n points of a scrambled Sobol sequence
+def sobol_uniforms(rng, n, d):
+	from scipy.stats import qmc
+
+	points = qmc.Sobol(d, scramble=True, seed=rng).random_base2(max(0, math.ceil(math.log2(n))))
+	return points[:n]
+
+
+# Standard normals from uniforms by inverse CDF
+def normal_quantiles(u):
+	normal = statistics.NormalDist()
+	return np.array([normal.inv_cdf(min(max(p, 1e-16), 1 - 1e-16)) for p in np.ravel(u)]).reshape(np.shape(u))
+
+
+# The (left, middle, right) points of a Brownian bridge over steps 0 to num_steps, coarse to fine
+def bridge_order(num_steps):
+	order = []
+	intervals = collections.deque([(0, num_steps)])
+	while intervals:
+		left, right = intervals.popleft()
+		if right - left > 1:
+			middle = (left + right)//2
+			order.append((left, middle, right))
+			intervals.extend([(left, middle), (middle, right)])
+
+	return order
+
+
+# Ball noise perturbations of shape (n, num_steps) from standard normals of the same shape
+# The perturbations of a sample add up to the walk of the ball's heading. The walk is built by
+# Brownian bridge: the first normal sets its end point, the next ones the midpoints of ever shorter
+# intervals. The perturbations are the steps of the walk, and are iid gaussians of scale noise as
+# when drawn one by one, but the leading normals decide the coarse shape of the walk, so that is
+# where stratified or low-discrepancy normals pay off.
+def bridge_perturbations(normals, noise):
+	n, num_steps = normals.shape
+	walk = np.zeros((n, num_steps + 1))
+	walk[:, num_steps] = math.sqrt(num_steps)*normals[:, 0]
+
+	for j, (left, middle, right) in enumerate(bridge_order(num_steps), start=1):
+		mean = ((right - middle)*walk[:, left] + (middle - left)*walk[:, right])/(right - left)
+		walk[:, middle] = mean + math.sqrt((middle - left)*(right - middle)/(right - left))*normals[:, j]
+
+	return np.diff(walk, axis=1)*noise
+
+
+# All random draws of num_samples removed-cause samples of a trial, made up front with a numpy Generator
+# Holds whether the brick moves in each sample, the brick start steps (drawn by inverse CDF,
+# see gate_start_quantiles) and the cos and sin of the noise rotation of the target ball at every
+# step after the collision. Simulations only index into the plan, and every sample is
+# reproducible from its index in a plan drawn with the same seed.
+# strategy is one of sampling_strategies, with qmc_dims leading ball noise normals drawn by it
+class SamplePlan():
+
+	def __init__(self, trial, cond, num_samples, ball_noise, brick_noise, collision_time, rng, step_max=700/speed_multiplier,
+		strategy='iid', qmc_dims=8):
+
+		if strategy not in sampling_strategies:
+			raise Exception('Sampling strategy', strategy, 'not implemented')
+
+		max_time = step_max + 1
+		brick_step = np.ceil(trial['bricks'][0]['step']/speed_multiplier)
+		# noise is drawn for every step after the collision up to and including step_max + 1
+		num_steps = math.floor(step_max) + 1 - collision_time
+		qmc_dims = min(qmc_dims, num_steps) if ball_noise != 0 else 0
+
+		if strategy == 'stratified':
+			points = stratified_uniforms(rng, num_samples, 1 + qmc_dims)
+		elif strategy == 'sobol':
+			points = sobol_uniforms(rng, num_samples, 2 + qmc_dims)
+
+		if cond == 'hypothetical':
+			self.move = rng.random(num_samples) < 0.5 if strategy == 'iid' else points[:, 0] < 0.5
+			no_move_step = max_time
+		elif cond == 'counterfactual':
+			self.move = np.full(num_samples, brick_step < step_max)
+			no_move_step = brick_step
+		else:
+			raise Exception("Condition", cond, "not implemented")
+
+		if strategy == 'iid':
+			u = rng.random(num_samples)
+		elif strategy == 'stratified':
+			u = rng.random(num_samples)
+			u[self.move] = stratified_uniforms(rng, int(self.move.sum()), 1)[:, 0]
+		else:
+			u = points[:, 1]
+
+		starts = gate_start_quantiles(u, brick_noise, trial['trial'], collision_time, max_time)
+		self.brick_steps = np.where(self.move, starts, no_move_step)
+
+		self.cos_noise = None
+		self.sin_noise = None
+		if ball_noise != 0:
+			if strategy == 'iid':
+				perturb = rng.normal(loc=0, scale=ball_noise, size=(num_samples, num_steps))
+			else:
+				normals = rng.standard_normal((num_samples, num_steps))
+				if qmc_dims > 0:
+					normals[:, :qmc_dims] = normal_quantiles(points[:, -qmc_dims:])
+				perturb = bridge_perturbations(normals, ball_noise)
+			self.cos_noise = np.cos(perturb*np.pi/180)
+			self.sin_noise = np.sin(perturb*np.pi/180)
+
+	# The cos and sin of the noise rotation of a sample (or a slice of samples), None without ball noise
+	def rotation(self, index):
+		if self.cos_noise is None:
+			return None
+
+		return self.cos_noise[index], self.sin_noise[index]
+
+
+# simulate ball B after ball A being removed for both cf and hp conditions
+
+# There are two differing conditions in this experiment where we will want to do simulations with
+# a removed cause ball
+
+# In the counterfactual condition, we simulate as in other experiments.
+# We remove the candidate cause and then apply noise to the movement of any ball that collided
+# with the candidate, to represent the thinker's uncertainty in how the other ball would have
+# moved after the collision.
+# We model uncertainty as to exactly when the brick moves in the scenarios where the brick
+# actually moves. In scenarios where the brick does not move, the model is certain that the
+# brick would not have moved in the counterfactual.
+
+# In the hypothetical condition, we simulate noise for the ball in the
+# same way as we do in the counterfactual condition.
+# Additionally, because the thinker did not view the gate's movement,
+# we simulate uncertainty as to whether and when the gate will move. 
+# If a snapshot from removed_prefix is given, the sample is forked from it
+# instead of stepping through the shared prefix again
+# If a WorldPool of the trial is given, its world is reset and reused instead of building a new one
+# early_exit stops the simulation once the outcome is decided (see World.decided_outcome)
+# If a SamplePlan is given, sample number index of the plan is simulated instead of drawing one
+# A recorder (see trajectories.py) records the trajectory of the sample
+def run_removed(trial, animate=False, track=False, ball_noise=1.5, collision_time=0,
+	brick_noise=0, cond='counterfactual', save=False, testing_output=False, snapshot=None, early_exit=False,
+	pool=None, plan=None, index=0, recorder=None):       
+
+	if animate and recorder is not None:
+		raise Exception('Samples can not be animated and recorded at once')
+
+	# world setup
+	with telemetry.section('world_setup'):
+		if pool is not None:
+			if animate:
+				raise Exception('Pooled worlds can not be animated')
+			w = pool.acquire()
+			snapshot = pool.snapshot
+		else:
+			w = build_removed(trial)
+
+	if plan is not None:
+		w.brick['step'] = plan.brick_steps[index]
+		w.rotation = plan.rotation(index)
+	else:
+		w.brick['step'] = sample_brick_step(trial, w.brick['step'], cond, brick_noise, collision_time, w.step_max)
+		w.rotation = None
+
+	# The brick must not have started moving within a forked prefix
+	if snapshot is not None and w.brick['step'] < snapshot['step']:
+		raise Exception('Brick start', w.brick['step'], 'falls within the shared prefix')
 
 	# Run the simulation with the cause removed and return the outcome
-	events = w.simulate(animate=animate, track=track, ball_noise=ball_noise, collision_time=collision_time, remove=True, save=save)
+	with telemetry.section('run_removed'):
+		if pool is not None:
+			events = w.run(ball_noise=ball_noise, collision_time=collision_time, early_exit=early_exit, renderer=recorder)
+		else:
+			events = w.simulate(animate=animate, track=track, ball_noise=ball_noise, collision_time=collision_time, remove=True, save=save, snapshot=snapshot, early_exit=early_exit,
+				renderer=recorder)
 
 	if not testing_output:
 		return events['outcome']['outcome_coarse']
@@ -508,7 +1185,8 @@ def run_removed(trial, animate=False, track=False, ball_noise=1.5, collision_tim
 	elif cond == 'hypothetical':
 		# Returns whether the block moved and it's starting time in addition to the outcome
 		# Can use to test the distribution of movement and start times
-		return {'outcome': events['outcome']['outcome_coarse'], 'movement': move, 'start_time': hypothetical_start if move else None}
+		move = w.brick['step'] <= w.step_max
+		return {'outcome': events['outcome']['outcome_coarse'], 'movement': int(move), 'start_time': w.brick['step'] if move else None}
 
 	else:
 		raise Exception('Condition must be hypothetical to return testing output')
@@ -517,26 +1195,382 @@ def run_removed(trial, animate=False, track=False, ball_noise=1.5, collision_tim
 
 # Produce a model judgement on a given trial using either hypothetical or counterfactual simulation
 # Model returns the number of samples that went through the gate divided by total samples
+# With fork=True the deterministic prefix up to the collision is simulated once
+# and every sample is forked from it (not used when animating)
+# engine selects between stepping one pymunk world per sample ('pymunk'),
+# advancing all samples at once with the vectorized engine in batch_model ('numpy')
+# and stepping many samples in one pymunk space with run_removed_multiplexed ('multiplex')
+# early_exit stops each pymunk sample as soon as its outcome is decided
+# With telemetry enabled, the exact judgements and the sampling are timed (see telemetry.py)
+# With reuse_world=True the pymunk samples reset and reuse the trial's WorldPool
+# instead of building a new world each (requires fork)
+# Without ball noise the outcome of a sample only depends on the brick start step.
+# In that case, with exact=True, the judgement is computed exactly by exact_judgement
+# instead of sampling
+# If target_ci is given, samples are drawn in batches of batch_size until the Wilson interval
+# on the proportion that went through is at most target_ci wide, or max_samples (by default
+# num_samples) were drawn. The model then returns a dict with the judgement, the interval
+# and the number of samples used.
+# If rng (a numpy Generator or a seed) is given, the random draws of each batch of samples are
+# made up front as a SamplePlan from it, instead of during the simulations from the global random state
+# sampling selects how the samples of a plan are drawn (see sampling_strategies). Strategies other
+# than iid always draw a plan, from a Generator seeded by the global random state if rng is not given.
+# If control_variate (a dict of options of control_variate_judgement, e.g. {'num_low': 800, 'low_fidelity': 'draft'})
+# is given, num_samples samples at fidelity are combined with coarse samples as a control variate
+# fidelity simulates the samples with the physics of another preset (see fidelities) from a SamplePlan,
+# drawn as with sampling strategies. Exact judgements are always made at the reference fidelity.
 def model_judgement(trial, condition, ball_noise=0.6, brick_noise=175, num_samples=100,
-	track=False, animate=False):
+	track=False, animate=False, fork=True, engine='pymunk', early_exit=False, exact=True,
+	target_ci=None, max_samples=None, batch_size=50, confidence=0.95, reuse_world=True, rng=None, sampling='iid',
+	control_variate=None, fidelity='reference'):
 
 	if condition not in {'counterfactual', 'hypothetical'}:
 		raise Exception('Condition', condition, 'not implemented')
 
-	events_actual = run_actual(trial, animate=animate)
-	collision_time = events_actual['collisions'][0]['step']
-	outcome = events_actual['outcome']['outcome_coarse']
+	if engine not in {'pymunk', 'numpy', 'multiplex'}:
+		raise Exception('Engine', engine, 'not implemented')
+
+	if animate:
+		events_actual = run_actual(trial, animate=animate)
+		collision_time = events_actual['collisions'][0]['step']
+	else:
+		collision_time = actual_world(trial)['collision_time']
+
+	if exact and ball_noise == 0 and not animate:
+		with telemetry.section('exact_judgement'):
+			judgement = exact_judgement(trial, condition, brick_noise, collision_time, engine=engine)
+		if target_ci is not None:
+			return {'judgement': judgement, 'interval': (judgement, judgement), 'num_samples': 0}
+		return judgement
+
+	if control_variate is not None:
+		if animate or target_ci is not None:
+			raise Exception('Control variates are not implemented with animation or adaptive sampling')
+		if rng is None:
+			rng = np.random.randint(2**31, size=4)
+		with telemetry.section('sampling', n=num_samples):
+			return control_variate_judgement(trial, condition, ball_noise=ball_noise, brick_noise=brick_noise, num_high=num_samples,
+				engine=engine, early_exit=early_exit, rng=rng, sampling=sampling, fidelity=fidelity, **control_variate)['judgement']
+
+	snapshot = None
+	pool = None
+	if fork and not animate:
+		snapshot = removed_prefix(trial, collision_time)
+		if reuse_world and engine == 'pymunk':
+			pool = world_pool(trial, collision_time)
+
+	if rng is not None:
+		rng = np.random.default_rng(rng)
+
+	if target_ci is None:
+		with telemetry.section('sampling', n=num_samples):
+			went_through = count_went_through(trial, condition, collision_time, num_samples, ball_noise=ball_noise,
+				brick_noise=brick_noise, engine=engine, snapshot=snapshot, track=track, animate=animate, early_exit=early_exit, pool=pool, rng=rng,
+				sampling=sampling, fidelity=fidelity)
+
+		return went_through/num_samples
+
+	if max_samples is None:
+		max_samples = num_samples
+
+	if max_samples < 1 or batch_size < 1:
+		raise Exception('Adaptive sampling needs at least one sample and batches of at least one sample, not', max_samples, batch_size)
 
 	went_through = 0
+	samples_used = 0
+	while True:
+		batch = min(batch_size, max_samples - samples_used)
+		with telemetry.section('sampling', n=batch):
+			went_through += count_went_through(trial, condition, collision_time, batch, ball_noise=ball_noise,
+				brick_noise=brick_noise, engine=engine, snapshot=snapshot, track=track, animate=animate, early_exit=early_exit, pool=pool, rng=rng,
+				sampling=sampling, fidelity=fidelity)
+		samples_used += batch
+
+		interval = wilson_interval(went_through, samples_used, confidence=confidence)
+		if interval[1] - interval[0] <= target_ci or samples_used >= max_samples:
+			break
+
+	return {'judgement': went_through/samples_used, 'interval': interval, 'num_samples': samples_used}
+
+
+# Wilson score interval for the proportion of successes out of n samples
+def wilson_interval(successes, n, confidence=0.95):
+	# no samples say nothing about the proportion
+	if n == 0:
+		return 0.0, 1.0
+
+	z = statistics.NormalDist().inv_cdf(0.5 + confidence/2)
+	p = successes/n
+
+	denominator = 1 + z**2/n
+	center = (p + z**2/(2*n))/denominator
+	half_width = z*math.sqrt(p*(1 - p)/n + z**2/(4*n**2))/denominator
+
+	return center - half_width, center + half_width
+
+
+# Draw num_samples removed-cause simulations of a trial and count how many went through the gate
+# collision_time and the optional prefix snapshot come from the actual world of the trial
+# The optional WorldPool is only used by the pymunk engine
+# If a numpy Generator is given as rng, the samples are drawn from it as a SamplePlan
+# with the given sampling strategy. Without rng, strategies other than iid and fidelities other
+# than the reference draw the plan from a Generator seeded by the global random state.
+def count_went_through(trial, condition, collision_time, num_samples, ball_noise=0.6, brick_noise=175,
+	engine='pymunk', snapshot=None, track=False, animate=False, early_exit=False, pool=None, rng=None, sampling='iid',
+	fidelity='reference'):
+
+	if rng is None and (sampling != 'iid' or fidelity != 'reference'):
+		rng = np.random.default_rng(np.random.randint(2**31, size=4))
+
+	plan = None
+	if rng is not None:
+		with telemetry.section('sample_plan'):
+			plan = SamplePlan(trial, condition, num_samples, ball_noise, brick_noise, collision_time, rng, strategy=sampling)
+
+	return int(sample_outcomes(trial, condition, collision_time, num_samples, ball_noise=ball_noise, brick_noise=brick_noise,
+		engine=engine, snapshot=snapshot, track=track, animate=animate, early_exit=early_exit, pool=pool, plan=plan, fidelity=fidelity).sum())
+
+
+# The coarse outcome of each of num_samples removed-cause simulations of a trial
+# If a SamplePlan is given, sample i is sample i of the plan
+# Fidelities other than the reference need a plan and the pymunk engine (see sample_outcomes_fidelity)
+def sample_outcomes(trial, condition, collision_time, num_samples, ball_noise=0.6, brick_noise=175,
+	engine='pymunk', snapshot=None, track=False, animate=False, early_exit=False, pool=None, plan=None, fidelity='reference'):
+
+	if fidelity != 'reference':
+		if plan is None or engine != 'pymunk' or animate:
+			raise Exception('Fidelity', fidelity, 'needs a sample plan and the pymunk engine without animation')
+		return sample_outcomes_fidelity(trial, collision_time, plan, ball_noise, fidelity=fidelity, early_exit=early_exit, num_samples=num_samples)
+
+	if engine == 'numpy':
+		import batch_model
+		return batch_model.run_removed_batch(trial, num_samples, ball_noise=ball_noise, collision_time=collision_time,
+			brick_noise=brick_noise, cond=condition, snapshot=snapshot, plan=plan)
+
+	if engine == 'multiplex':
+		return run_removed_multiplexed(trial, num_samples, ball_noise=ball_noise, collision_time=collision_time,
+			brick_noise=brick_noise, cond=condition, snapshot=snapshot, plan=plan)
+
+	outcomes = np.zeros(num_samples, dtype=int)
+
+	for i in range(num_samples):
+
+		outcomes[i] = run_removed(trial, animate=animate, track=track, ball_noise=ball_noise, collision_time=collision_time, brick_noise=brick_noise, cond=condition, save=False, testing_output=False, snapshot=snapshot, early_exit=early_exit, pool=pool, plan=plan, index=i)
+
+	return outcomes
+
+
+# The coarse outcomes of the samples of a SamplePlan, simulated with the physics of fidelity
+# (see fidelities) in worlds from the fidelity's WorldPool. With a step_factor above 1, every step
+# starts the brick if its reference start step falls within it, and rotates ball B by the sum of
+# the reference noise perturbations of step_factor consecutive steps after the collision.
+# With num_samples, only the first num_samples samples of the plan are simulated.
+def sample_outcomes_fidelity(trial, collision_time, plan, ball_noise, fidelity='draft', early_exit=False, num_samples=None):
+	step_factor = fidelity_settings(fidelity)['step_factor']
+	coarse_time = collision_time//step_factor
+	pool = world_pool(trial, coarse_time, fidelity=fidelity)
+	if num_samples is None:
+		num_samples = len(plan.brick_steps)
+	elif num_samples > len(plan.brick_steps):
+		raise Exception('The sample plan has', len(plan.brick_steps), 'samples, not', num_samples)
+
+	rotation = None
+	if plan.cos_noise is not None and step_factor == 1:
+		rotation = (plan.cos_noise, plan.sin_noise)
+	elif plan.cos_noise is not None:
+		angles = np.arctan2(plan.sin_noise[:num_samples], plan.cos_noise[:num_samples])
+		num_draws = math.floor(pool.world.step_max) + 1 - coarse_time
+		padded = np.zeros((num_samples, max(num_draws, -(-angles.shape[1]//step_factor))*step_factor))
+		padded[:, :angles.shape[1]] = angles
+		coarse_angles = padded.reshape(num_samples, -1, step_factor).sum(axis=2)
+		rotation = (np.cos(coarse_angles), np.sin(coarse_angles))
+
+	outcomes = np.zeros(num_samples, dtype=int)
+	for i in range(num_samples):
+		w = pool.acquire()
+		w.brick['step'] = np.ceil(plan.brick_steps[i]/step_factor)
+		w.rotation = None if rotation is None else (rotation[0][i], rotation[1][i])
+		events = w.run(ball_noise=ball_noise, collision_time=coarse_time, early_exit=early_exit)
+		outcomes[i] = events['outcome']['outcome_coarse']
+
+	return outcomes
+
+
+# A judgement estimated from num_low samples at low_fidelity (see sample_outcomes_fidelity) and the first
+# num_high of the same samples at full fidelity, with the coarse outcomes as a control variate:
+# mean(high) + mean(low of all num_low) - mean(low of the num_high paired samples)
+# The coarse terms cancel in expectation, so the estimate is unbiased for the full-fidelity judgement,
+# and its variance is var(high - low)/num_high + var(low)/num_low (up to the overlap of the two sets).
+# If the paired outcomes correlate less than min_correlation, or the estimate would take longer than
+# plain sampling to reach its variance, the coarse samples are not worth it. The judgement then falls
+# back to plain sampling, with as many more full-fidelity samples as the time of the coarse ones buys.
+# Returns a dict with the judgement, the paired correlation, whether it fell back, the estimated
+# variance and that of plain sampling with num_high samples, the seconds per sample of both
+# fidelities, and the savings: the time plain sampling needs for the same variance over the time taken.
+# The full-fidelity samples are simulated with the physics of fidelity (see fidelities), which only
+# the pymunk engine implements besides the reference preset.
+def control_variate_judgement(trial, condition, ball_noise=0.6, brick_noise=175, num_high=50, num_low=400, low_fidelity='draft',
+	min_correlation=0.5, engine='pymunk', early_exit=False, rng=None, sampling='iid', fidelity='reference'):
+
+	if not 1 <= num_high <= num_low:
+		raise Exception('Control variates need at least one full-fidelity sample and at least as many coarse samples, not', num_high, num_low)
+
+	collision_time = actual_world(trial)['collision_time']
+	snapshot = removed_prefix(trial, collision_time)
+	pool = world_pool(trial, collision_time) if engine == 'pymunk' else None
+	rng = np.random.default_rng(rng)
+	plan = SamplePlan(trial, condition, num_low, ball_noise, brick_noise, collision_time, rng, strategy=sampling)
+
+	t_start = time.perf_counter()
+	high = sample_outcomes(trial, condition, collision_time, num_high, ball_noise=ball_noise, brick_noise=brick_noise,
+		engine=engine, snapshot=snapshot, early_exit=early_exit, pool=pool, plan=plan, fidelity=fidelity)
+	t_high = (time.perf_counter() - t_start)/num_high
+
+	t_start = time.perf_counter()
+	low = sample_outcomes_fidelity(trial, collision_time, plan, ball_noise, fidelity=low_fidelity, early_exit=early_exit)
+	t_low = (time.perf_counter() - t_start)/num_low
+
+	paired = low[:num_high]
+	if high.std() > 0 and paired.std() > 0:
+		correlation = np.corrcoef(high, paired)[0, 1]
+	else:
+		correlation = 1.0 if np.array_equal(high, paired) else 0.0
+
+	plain_variance = high.var(ddof=1)/num_high if num_high > 1 else np.nan
+	result = {'correlation': correlation, 'plain_variance': plain_variance, 'seconds_high': t_high, 'seconds_low': t_low, 'num_high': num_high, 'num_low': num_low}
+
+	variance = (high - paired).var(ddof=1)/num_high + low.var(ddof=1)/num_low
+	cost = num_high*t_high + num_low*t_low
+	savings = plain_variance/variance*num_high*t_high/cost if variance > 0 else np.inf
+
+	if correlation < min_correlation or savings < 1:
+		extra = int(num_low*t_low/t_high)
+		if extra > 0:
+			more_plan = SamplePlan(trial, condition, extra, ball_noise, brick_noise, collision_time, rng, strategy=sampling)
+			high = np.concatenate([high, sample_outcomes(trial, condition, collision_time, extra, ball_noise=ball_noise, brick_noise=brick_noise,
+				engine=engine, snapshot=snapshot, early_exit=early_exit, pool=pool, plan=more_plan, fidelity=fidelity)])
+		result.update({'judgement': high.mean(), 'fallback': True, 'num_high': len(high), 'variance': high.var(ddof=1)/len(high),
+			'savings': 1.0})
+		return result
+
+	judgement = high.mean() + low.mean() - paired.mean()
+	result.update({'judgement': judgement, 'fallback': False, 'variance': variance, 'savings': savings})
+	return result
+
+
+# Simulate one removed-cause sample for each of the given brick start steps and return the outcomes
+def simulate_start_steps(trial, collision_time, steps, ball_noise=0, engine='pymunk', early_exit=False):
+	snapshot = removed_prefix(trial, collision_time)
+
+	if engine == 'numpy':
+		import batch_model
+		return batch_model.simulate_batch(batch_model.scene(trial), snapshot, np.array(steps), ball_noise, collision_time)
+
+	if engine == 'multiplex':
+		return run_removed_multiplexed(trial, len(steps), ball_noise=ball_noise, collision_time=collision_time,
+			snapshot=snapshot, brick_steps=steps)
+
+	pool = world_pool(trial, collision_time)
+	outcomes = np.zeros(len(steps), dtype=int)
+	for i, step in enumerate(steps):
+		w = pool.acquire()
+		w.brick['step'] = step
+		w.rotation = None
+		events = w.run(ball_noise=ball_noise, collision_time=collision_time, early_exit=early_exit)
+		outcomes[i] = events['outcome']['outcome_coarse']
+
+	return outcomes
+
+
+# Outcomes of the removed-cause simulation without ball noise for the given brick start steps
+# Every start step is only simulated once per trial, the outcomes are kept in outcome_tables
+def start_step_outcomes(trial, collision_time, steps, engine='pymunk'):
+	table = outcome_tables.setdefault((actual_key(trial), collision_time, engine), {})
+
+	missing = [int(step) for step in steps if int(step) not in table]
+	if len(missing) > 0:
+		outcomes = simulate_start_steps(trial, collision_time, missing, engine=engine, early_exit=True)
+		table.update(zip(missing, outcomes.tolist()))
+
+	return np.array([table[int(step)] for step in steps])
+
+
+# The exact judgement for a trial without ball noise
+# The outcomes for every possible brick start step are weighted with the probability of that
+# start step under the condition's procedure in run_removed
+def exact_judgement(trial, condition, brick_noise, collision_time, engine='pymunk'):
+	w = build_removed(trial)
+	max_time = w.step_max + 1
+
+	# the brick moves with uncertain start time in the hypothetical condition
+	# and in counterfactuals of trials where it moves in the actual world
+	if condition == 'hypothetical' or w.brick['step'] < w.step_max:
+		steps, probs = gate_start_distribution(brick_noise, trial['trial'], collision_time, max_time)
+		steps = steps[probs > 0]
+		probs = probs[probs > 0]
+		judgement = float(np.dot(probs, start_step_outcomes(trial, collision_time, steps, engine=engine)))
+
+	if condition == 'hypothetical':
+		# the brick doesn't move with probability 0.5
+		no_move = float(start_step_outcomes(trial, collision_time, [max_time], engine=engine)[0])
+		return 0.5*no_move + 0.5*judgement
+
+	elif condition == 'counterfactual':
+		if w.brick['step'] < w.step_max:
+			return judgement
+
+		return float(start_step_outcomes(trial, collision_time, [w.brick['step']], engine=engine)[0])
+
+	else:
+		raise Exception("Condition", condition, "not implemented")
+
+
+# Judgements for several brick noise values from a single set of simulations
+# Brick start steps are drawn from a proposal, the equal mixture of the start step distributions
+# for proposal_noise (by default brick_noise_values), and every sample is simulated once.
+# The judgement for each brick noise value is then a self-normalized importance sampling estimate,
+# weighting each sample by the ratio of its start step's probability under that brick noise
+# and under the proposal. Samples where the brick doesn't move keep a weight of 1.
+# Returns the judgements and the effective sample size for each brick noise value
+def reweighted_judgements(trial, condition, ball_noise, brick_noise_values, num_samples=100, proposal_noise=None,
+	engine='pymunk', early_exit=False):
+
+	if proposal_noise is None:
+		proposal_noise = brick_noise_values
+
+	collision_time = actual_world(trial)['collision_time']
+	w = build_removed(trial)
+	max_time = w.step_max + 1
+
+	steps = gate_start_distribution(0, trial['trial'], collision_time, max_time)[0]
+	targets = np.array([gate_start_distribution(bnoise, trial['trial'], collision_time, max_time)[1] for bnoise in brick_noise_values])
+	proposal = np.mean([gate_start_distribution(bnoise, trial['trial'], collision_time, max_time)[1] for bnoise in proposal_noise], axis=0)
+
+	if np.any((targets > 0) & (proposal == 0)):
+		raise Exception('Proposal', proposal_noise, 'does not cover the start steps of', brick_noise_values)
+
+	# whether the brick moves follows the condition's procedure in run_removed
+	if condition == 'hypothetical':
+		move = np.random.binomial(1, 0.5, size=num_samples).astype(bool)
+		sample_steps = np.full(num_samples, max_time)
+	elif condition == 'counterfactual':
+		move = np.full(num_samples, w.brick['step'] < w.step_max)
+		sample_steps = np.full(num_samples, w.brick['step'])
+	else:
+		raise Exception("Condition", condition, "not implemented")
 
-	for _ in range(num_samples):
+	index = np.random.choice(len(steps), size=move.sum(), p=proposal)
+	sample_steps[move] = steps[index]
 
-		sim_outcome = run_removed(trial, animate=animate, track=track, ball_noise=ball_noise, collision_time=collision_time, brick_noise=brick_noise, cond=condition, save=False, testing_output=False)
+	outcomes = simulate_start_steps(trial, collision_time, sample_steps, ball_noise=ball_noise, engine=engine, early_exit=early_exit)
 
-		went_through += sim_outcome
+	weights = np.ones((len(brick_noise_values), num_samples))
+	weights[:, move] = targets[:, index]/proposal[index]
 
-	return went_through/num_samples
+	judgements = np.sum(weights*outcomes, axis=1)/np.sum(weights, axis=1)
+	ess = np.sum(weights, axis=1)**2/np.sum(weights**2, axis=1)
 
+	return judgements, ess
 
 
 # A simple test to check whether the binomial distribution comes out looking roughly right
@@ -585,4 +1619,131 @@ def test_hypothetical_normal_dist(trial, brick_noise=175):
 	print(start_samples)
 
 	sns.distplot(start_samples)
-	plt.show()
\ No newline at end of file
+	plt.show()
+
+# A test to check that stopping simulations once their outcome is decided doesn't change them
+# For every trial and condition, the same seeded sequence of samples is drawn with and without
+# early exit, and outcomes and the final random state must be identical
+# Returns the time taken with and without early exit
+def test_early_exit(trials, ball_noise_values=[0, 0.9], brick_noise=100, num_samples=100, seed=1):
+
+	timing = {False: 0, True: 0}
+
+	for trial in trials:
+		col1_time = actual_world(trial)['collision_time']
+		snapshot = removed_prefix(trial, col1_time)
+
+		for cond in ['hypothetical', 'counterfactual']:
+			for ball_noise in ball_noise_values:
+				outcomes = {}
+				final_state = {}
+
+				for early_exit in [False, True]:
+					np.random.seed(seed)
+					t_start = time.time()
+					outcomes[early_exit] = [run_removed(trial, ball_noise=ball_noise, collision_time=col1_time, brick_noise=brick_noise,
+						cond=cond, snapshot=snapshot, early_exit=early_exit) for _ in range(num_samples)]
+					timing[early_exit] += time.time() - t_start
+					final_state[early_exit] = np.random.get_state()[1]
+
+				assert outcomes[False] == outcomes[True], ('Outcomes differ', trial['trial'], cond, ball_noise)
+				assert np.array_equal(final_state[False], final_state[True]), ('Random state differs', trial['trial'], cond, ball_noise)
+
+	print("Time without early exit:", timing[False])
+	print("Time with early exit:", timing[True])
+
+	return timing
+
+# A test to check that multiplexing samples into one space doesn't change their outcomes
+# For every trial and condition, the same seeded samples are drawn one world per sample
+# and multiplexed. The random state must be used in the same way by both, the share of
+# samples with the same outcome is reported and the judgements must agree within
+# tolerance, which allows for the rare sample where the contact solver's order differs.
+# Returns the time taken by both
+def test_multiplexed(trials, ball_noise_values=[0, 0.9], brick_noise=100, num_samples=100, seed=1, tolerance=0.05):
+
+	timing = {'pymunk': 0, 'multiplex': 0}
+
+	for trial in trials:
+		col1_time = actual_world(trial)['collision_time']
+		snapshot = removed_prefix(trial, col1_time)
+
+		for cond in ['hypothetical', 'counterfactual']:
+			for ball_noise in ball_noise_values:
+				np.random.seed(seed)
+				t_start = time.time()
+				single = np.array([run_removed(trial, ball_noise=ball_noise, collision_time=col1_time, brick_noise=brick_noise,
+					cond=cond, snapshot=snapshot) for _ in range(num_samples)])
+				timing['pymunk'] += time.time() - t_start
+				single_state = np.random.get_state()[1]
+
+				np.random.seed(seed)
+				t_start = time.time()
+				multiplexed = run_removed_multiplexed(trial, num_samples, ball_noise=ball_noise, collision_time=col1_time,
+					brick_noise=brick_noise, cond=cond, snapshot=snapshot)
+				timing['multiplex'] += time.time() - t_start
+
+				assert np.array_equal(single_state, np.random.get_state()[1]), ('Random state differs', trial['trial'], cond, ball_noise)
+				assert abs(single.mean() - multiplexed.mean()) <= tolerance, ('Judgements differ', trial['trial'], cond, ball_noise)
+				print("Trial", trial['trial'], cond, "ball noise", ball_noise, "same outcome:", np.mean(single == multiplexed))
+
+	print("Time one world per sample:", timing['pymunk'])
+	print("Time multiplexed:", timing['multiplex'])
+
+	return timing
+
+# A test to check that a pooled world doesn't keep the planned rotation of a SamplePlan
+# The same seeded pooled samples must have the same outcomes and random state on a fresh
+# pool and on a pool that just simulated the samples of a plan
+def test_pool_rotation(trial, ball_noise=0.9, brick_noise=100, num_samples=50, seed=1):
+
+	col1_time = actual_world(trial)['collision_time']
+	outcomes = {}
+	final_state = {}
+
+	for after_plan in [False, True]:
+		world_pools.clear()
+		if after_plan:
+			model_judgement(trial, condition='counterfactual', ball_noise=ball_noise, brick_noise=brick_noise, num_samples=10, rng=seed)
+
+		steps = np.full(num_samples, math.floor(world_pool(trial, col1_time).world.step_max) + 1)
+		np.random.seed(seed)
+		outcomes[after_plan] = simulate_start_steps(trial, col1_time, steps, ball_noise=ball_noise)
+		final_state[after_plan] = np.random.get_state()[1]
+
+	assert np.array_equal(outcomes[False], outcomes[True]), ('Outcomes differ after a sample plan', trial['trial'])
+	assert np.array_equal(final_state[False], final_state[True]), ('Random state differs after a sample plan', trial['trial'])
+
+# A test to check that enabling telemetry doesn't change the simulations
+# The actual world and the same seeded pooled samples must have the same events and outcomes with
+# telemetry disabled and enabled. The pool is built while telemetry is disabled, so its world must
+# follow the state of telemetry when it is acquired. The collision handlers must be timed.
+def test_telemetry(trial, ball_noise=0.9, brick_noise=100, num_samples=50, seed=1):
+
+	was_enabled = telemetry.enabled
+	col1_time = actual_world(trial)['collision_time']
+	snapshot = removed_prefix(trial, col1_time)
+	world_pools.clear()
+	pool = world_pool(trial, col1_time)
+	events = {}
+	outcomes = {}
+
+	try:
+		for enabled in [False, True]:
+			telemetry.reset()
+			if enabled:
+				telemetry.enable()
+			else:
+				telemetry.disable()
+
+			events[enabled] = run_actual(trial)
+			np.random.seed(seed)
+			outcomes[enabled] = [run_removed(trial, ball_noise=ball_noise, collision_time=col1_time, brick_noise=brick_noise,
+				cond='counterfactual', snapshot=snapshot, pool=pool) for _ in range(num_samples)]
+
+		assert events[False] == events[True], ('Actual world events differ with telemetry', trial['trial'])
+		assert outcomes[False] == outcomes[True], ('Outcomes differ with telemetry', trial['trial'])
+		assert telemetry.calls['collisions'] > 0, ('Collision handlers are not timed', trial['trial'])
+	finally:
+		if not was_enabled:
+			telemetry.disable()
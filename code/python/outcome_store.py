@@ -0,0 +1,118 @@
+# A store of every sampled outcome of a grid of parameter settings
+# record_outcomes simulates num_samples samples per cell, trial and condition and saves them in
+# a single npz file: the outcomes as packed bits and the brick start step of every sample, along
+# with the parameters of every cell and the seed. The samples of a cell, trial i and condition k
+# are those of the sample plan seeded from the seed, the parameters of the cell, i and k (see sample_seed),
+# so any sample can be simulated again, whatever grid the cell was part of.
+# OutcomeStore loads the file and computes predictions, losses and bootstrap intervals
+# for all cells at once, so fitting to other human data doesn't need new simulations.
+
+import model
+import fit_model
+import numpy as np
+import pandas as pd
+import time
+
+
+# Parameters are scaled to integers in the seed, with this many steps per unit
+seed_scale = 10000
+
+
+# The SeedSequence of the samples of trial i and condition k in the cell (unoise, bnoise)
+def sample_seed(seed, unoise, bnoise, i, k):
+	return np.random.SeedSequence(seed, spawn_key=(int(round(unoise*seed_scale)), int(round(bnoise*seed_scale)), i, k))
+
+
+def record_outcomes(path, unoise_range, bnoise_range, num_samples, seed=0, engine='pymunk'):
+	trials = model.load_trials(fit_model.trial_path)[:8]
+	conditions = fit_model.conditions
+	collision_times = [model.actual_world(tr)['collision_time'] for tr in trials]
+	snapshots = [model.removed_prefix(tr, ct) for tr, ct in zip(trials, collision_times)]
+	pools = [model.world_pool(tr, ct) if engine == 'pymunk' else None for tr, ct in zip(trials, collision_times)]
+
+	cells = np.array([(unoise, bnoise) for unoise in unoise_range for bnoise in bnoise_range], dtype=float)
+	outcomes = np.zeros((len(cells), len(trials), len(conditions), num_samples), dtype=bool)
+	brick_steps = np.zeros((len(cells), len(trials), len(conditions), num_samples), dtype=np.int16)
+
+	t_start = time.time()
+	for c, (unoise, bnoise) in enumerate(cells):
+		for i, tr in enumerate(trials):
+			for k, condition in enumerate(conditions):
+				rng = np.random.default_rng(sample_seed(seed, unoise, bnoise, i, k))
+				plan = model.SamplePlan(tr, condition, num_samples, unoise, bnoise, collision_times[i], rng)
+
+				outcomes[c, i, k] = model.sample_outcomes(tr, condition, collision_times[i], num_samples, ball_noise=unoise, brick_noise=bnoise,
+					engine=engine, snapshot=snapshots[i], pool=pools[i], plan=plan)
+				brick_steps[c, i, k] = plan.brick_steps
+
+		print('cell', c + 1, 'out of', len(cells), 'time:', time.time() - t_start)
+
+	np.savez_compressed(path, cells=cells, outcomes=np.packbits(outcomes, axis=-1), brick_steps=brick_steps,
+		num_samples=num_samples, seed=seed)
+
+
+# Squared error loss (as fit_model.calculate_loss), absolute error and one minus the correlation
+# of predictions of shape (..., trials, conditions) with the human data
+def squared_loss(predictions, human_data):
+	return np.sum((predictions - human_data)**2, axis=(-2, -1))
+
+
+def absolute_loss(predictions, human_data):
+	return np.sum(np.abs(predictions - human_data), axis=(-2, -1))
+
+
+def correlation_loss(predictions, human_data):
+	shape = predictions.shape[:-2]
+	p = predictions.reshape(shape + (-1,))
+	h = human_data.reshape(-1)
+	p = p - p.mean(axis=-1, keepdims=True)
+	h = h - h.mean()
+	return 1 - np.sum(p*h, axis=-1)/np.sqrt(np.sum(p**2, axis=-1)*np.sum(h**2))
+
+
+losses = {'squared': squared_loss, 'absolute': absolute_loss, 'correlation': correlation_loss}
+
+
+class OutcomeStore():
+
+	def __init__(self, path):
+		with np.load(path) as data:
+			self.cells = data['cells']
+			self.num_samples = int(data['num_samples'])
+			self.seed = int(data['seed'])
+			self.brick_steps = data['brick_steps']
+			packed = data['outcomes']
+
+		self.outcomes = np.unpackbits(packed, axis=-1, count=self.num_samples).astype(bool)
+		self.went_through = self.outcomes.sum(axis=-1)
+
+	# Predictions of every cell, shape (cells, trials, conditions)
+	# With num_samples, only the first num_samples samples of every judgement are used
+	def predictions(self, num_samples=None):
+		if num_samples is None:
+			return self.went_through/self.num_samples
+
+		return self.outcomes[..., :num_samples].sum(axis=-1)/num_samples
+
+	# The loss of every cell, loss is a name in losses or a function like them
+	def loss(self, human_data, loss='squared', num_samples=None):
+		loss_function = losses[loss] if isinstance(loss, str) else loss
+		return loss_function(self.predictions(num_samples=num_samples), human_data)
+
+	# Percentile bootstrap intervals of the loss of every cell, shape (cells, 2)
+	# Resampling the outcomes of a judgement with replacement gives a binomial
+	# number of successes, so every resample is drawn as such
+	def bootstrap(self, human_data, loss='squared', num_boot=1000, confidence=0.95, seed=0):
+		loss_function = losses[loss] if isinstance(loss, str) else loss
+		rng = np.random.default_rng(seed)
+
+		p = self.predictions()
+		resamples = rng.binomial(self.num_samples, np.broadcast_to(p, (num_boot,) + p.shape))/self.num_samples
+		boot_losses = loss_function(resamples, human_data)
+
+		alpha = (1 - confidence)/2
+		return np.quantile(boot_losses, [alpha, 1 - alpha], axis=0).T
+
+	# The losses in the format of fit_model.grid_search, for visualize_loss_landscape
+	def grid_frame(self, human_data, loss='squared'):
+		return pd.DataFrame({'unoise': self.cells[:, 0], 'bnoise': self.cells[:, 1], 'loss': self.loss(human_data, loss=loss)})
@@ -0,0 +1,252 @@
+# Renderers for animating a World
+# The simulation core in model.py doesn't depend on pygame. World.simulate calls
+# a renderer's draw() once per frame before advancing the world, and close() when
+# the clip is done. Only this module imports pygame, so headless simulations
+# neither pay for it nor need SDL installed.
+
+import sys
+import os
+import math
+import queue
+import threading
+import subprocess
+import zipfile
+import zlib
+import struct
+import numpy as np
+import pygame
+from pygame.locals import *
+from pymunk import Vec2d
+
+# Sprites by body name and rotated sprites by body name and angle, loaded once per process
+sprites = {}
+rotated_sprites = {}
+
+
+def load_sprite(name):
+	if name not in sprites:
+		sprites[name] = pygame.image.load('figures/' + name + '.png')
+	return sprites[name]
+
+
+# The sprite of a body rotated by angle_degrees, rounded to a tenth of a degree
+def rotated_sprite(name, angle_degrees):
+	key = (name, round(angle_degrees, 1))
+	if key not in rotated_sprites:
+		rotated_sprites[key] = pygame.transform.rotate(load_sprite(name), key[1])
+	return rotated_sprites[key]
+
+
+# The interface World.simulate expects from a renderer
+class Renderer():
+
+	# Draw the current state of the world
+	def draw(self, world):
+		pass
+
+	# Release any resources once the simulation is done
+	def close(self):
+		pass
+
+
+# Draws the scene with pygame onto a surface, shared by the window and the offscreen renderers
+# Sprites are loaded on first use
+class SceneRenderer(Renderer):
+
+	def __init__(self, track=True):
+		self.track = track
+
+	def flipy(self, y):
+	    """Small hack to convert chipmunk physics to pygame coordinates"""
+	    return -y+600
+
+	def update_sprite(self,body,sprite,screen):
+		p = body.position
+		p = Vec2d(p.x, self.flipy(p.y))
+		rotated_shape = rotated_sprite(body.name, math.degrees(body.angle))
+		offset = Vec2d(rotated_shape.get_size()) / 2.
+		p = p - offset
+		screen.blit(rotated_shape, p)
+
+	def draw_scene(self, world, screen):
+		# draw screen, background and bodies
+		screen.fill((255,255,255)) #background
+
+		# draw red gate
+		pygame.draw.rect(screen, pygame.color.THECOLORS['red'], [0, 150, 20, 300])  # 0, 200, 20 ,200
+
+		# draw sliding track if track == True
+		if self.track==True:
+			pygame.draw.line(screen, (125, 45, 30), (144, 105), (144, 300), 3)  # left track
+			pygame.draw.line(screen, (125, 45, 30), (156, 105), (156, 300), 3)  # right track
+
+			pygame.draw.circle(screen, (125, 45, 30), (144, 105), 3, 3)  # top-left dot
+			pygame.draw.circle(screen, (125, 45, 30), (156, 105), 3, 3)  # top-right dot
+			pygame.draw.circle(screen, (125, 45, 30), (144, 300), 3, 3)  # bottom-left dot
+			pygame.draw.circle(screen, (125, 45, 30), (156, 300), 3, 3)  # bottom-left dot
+
+		for body in world.bodies:
+			if 'sensor' not in body:
+				self.update_sprite(body = world.bodies.get(body), sprite = load_sprite(body),screen = screen)
+
+		# the walls are drawn on top of the bodies
+		# pygame.draw.rect(screen, pygame.color.THECOLORS['red'], [0,200,20,200]) #goal
+		pygame.draw.rect(screen, pygame.color.THECOLORS['black'], [0,0,800,20]) #top wall
+		pygame.draw.rect(screen, pygame.color.THECOLORS['black'], [0,580,800,20]) #bottom wall
+		pygame.draw.rect(screen, pygame.color.THECOLORS['black'], [0,0,20,150])
+		pygame.draw.rect(screen, pygame.color.THECOLORS['black'], [0,450,20,200])
+
+
+# Draws the world into a pygame window, optionally saving every frame as a png
+# Playback is throttled to 100 frames per second, see OffscreenRenderer for fast exports
+class PygameRenderer(SceneRenderer):
+
+	def __init__(self, world, track=True, save=False):
+		SceneRenderer.__init__(self, track=track)
+		self.save = save
+
+		pygame.init()
+		self.clock = pygame.time.Clock()
+		self.screen = pygame.display.set_mode((world.width, world.height))
+		pygame.display.set_caption("Animation")
+		self.pic_count = 0 # used for saving images
+		if self.save:
+			os.makedirs('figures/frames', exist_ok=True)
+
+	def draw(self, world):
+		screen = self.screen
+
+		# quit conditions
+		for event in pygame.event.get():
+			if event.type==QUIT:
+				pygame.quit()
+				sys.exit(0)
+			elif event.type == KEYDOWN and event.key == K_ESCAPE:
+				pygame.quit()
+				sys.exit(0)
+
+		self.draw_scene(world, screen)
+
+		# Update the screen
+		pygame.display.flip()
+		self.clock.tick(100)
+
+		if self.save:
+			pygame.image.save(screen, 'figures/frames/animation'+'{:03}'.format(self.pic_count)+'.png')
+			self.pic_count += 1
+
+	def close(self):
+		# quit pygame
+		pygame.display.quit()
+
+
+# Encode raw rgb bytes as a png
+# pygame's png encoder compresses hard and takes most of the time of an export, so frames
+# are compressed with a fast zlib level instead (zlib also lets other threads run meanwhile)
+def encode_png(frame, size, level=1):
+	width, height = size
+	rows = np.frombuffer(frame, dtype=np.uint8).reshape(height, 3*width)
+	# every row starts with its filter type, 0 for none
+	raw = np.hstack([np.zeros((height, 1), dtype=np.uint8), rows]).tobytes()
+
+	def chunk(kind, data):
+		return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+	header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+	return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(raw, level)) + chunk(b'IEND', b'')
+
+
+# Writes frames on a background thread, so that encoding doesn't hold up the simulation
+# The frames are written to one of three sinks:
+# 'png': a png per frame into the directory path, named like the frames of PygameRenderer
+# 'archive': a png per frame into the zip file path
+# 'video': a single video file path, encoded by piping raw frames into ffmpeg (which must be installed)
+class FrameWriter():
+
+	def __init__(self, path, mode='png', size=(800, 600), fps=50, max_queued=64):
+		self.path = path
+		self.mode = mode
+		self.size = size
+		self.queue = queue.Queue(maxsize=max_queued)
+
+		if mode == 'png':
+			os.makedirs(path, exist_ok=True)
+		elif mode == 'archive':
+			os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+			# pngs are already compressed
+			self.archive = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_STORED)
+		elif mode == 'video':
+			os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+			self.ffmpeg = subprocess.Popen(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+				'-s', '{}x{}'.format(*size), '-r', str(fps), '-i', '-', '-pix_fmt', 'yuv420p', path], stdin=subprocess.PIPE)
+		else:
+			raise Exception('Frame export mode', mode, 'not implemented')
+
+		self.error = None
+		self.thread = threading.Thread(target=self.work, daemon=True)
+		self.thread.start()
+
+	# Queue the raw rgb bytes of a frame
+	def put(self, index, frame):
+		if self.error is not None:
+			raise self.error
+		self.queue.put((index, frame))
+
+	def work(self):
+		try:
+			while True:
+				item = self.queue.get()
+				if item is None:
+					break
+				self.write(*item)
+		except Exception as e:
+			self.error = e
+			# keep draining so that put() doesn't block
+			while self.queue.get() is not None:
+				pass
+
+	def write(self, index, frame):
+		if self.mode == 'video':
+			self.ffmpeg.stdin.write(frame)
+			return
+
+		name = 'animation' + '{:03}'.format(index) + '.png'
+		data = encode_png(frame, self.size)
+		if self.mode == 'png':
+			with open(os.path.join(self.path, name), 'wb') as f:
+				f.write(data)
+		else:
+			self.archive.writestr(name, data)
+
+	# Wait until all frames are written and close the sink
+	def close(self):
+		self.queue.put(None)
+		self.thread.join()
+
+		if self.mode == 'archive':
+			self.archive.close()
+		elif self.mode == 'video':
+			self.ffmpeg.stdin.close()
+			self.ffmpeg.wait()
+
+		if self.error is not None:
+			raise self.error
+
+
+# Draws the world onto an offscreen surface without a window or frame rate cap
+# and hands every frame to a FrameWriter
+class OffscreenRenderer(SceneRenderer):
+
+	def __init__(self, path, mode='png', track=True, size=(800, 600), fps=50):
+		SceneRenderer.__init__(self, track=track)
+		self.screen = pygame.Surface(size)
+		self.writer = FrameWriter(path, mode=mode, size=size, fps=fps)
+		self.pic_count = 0
+
+	def draw(self, world):
+		self.draw_scene(world, self.screen)
+		self.writer.put(self.pic_count, pygame.image.tostring(self.screen, 'RGB'))
+		self.pic_count += 1
+
+	def close(self):
+		self.writer.close()
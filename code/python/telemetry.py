@@ -0,0 +1,146 @@
+# Opt-in instrumentation of the simulations
+# When enabled, World.run steps worlds with World.timed_advance, which times the parts of every
+# step, and the collision handlers are wrapped in timers. The layers above (world setup,
+# run_actual, run_removed, model_judgement and the sampling in count_went_through) add their
+# own sections. When disabled, the only cost is checking the enabled flag once per world and
+# once per call of these layers.
+# Timings are kept per process: simulations in the worker processes of fit_model are not included.
+
+import collections
+import csv
+import json
+import os
+import time
+
+enabled = False
+
+# total seconds and number of calls per section
+seconds = collections.defaultdict(float)
+calls = collections.defaultdict(int)
+
+# counts of things that are not timed, like samples and steps
+counts = collections.defaultdict(int)
+
+# one dict per finished grid search cell, see fit_model.grid_search
+records = []
+
+
+def enable():
+	global enabled
+	enabled = True
+
+
+def disable():
+	global enabled
+	enabled = False
+
+
+def reset():
+	seconds.clear()
+	calls.clear()
+	counts.clear()
+	records.clear()
+
+
+# Add elapsed seconds over n calls to a section
+def add(section, elapsed, n=1):
+	seconds[section] += elapsed
+	calls[section] += n
+
+
+# Count n occurrences of something that is not timed, like steps
+def count(name, n=1):
+	counts[name] += n
+
+
+# Time the body of a with statement as a section, if telemetry is enabled
+# n is the number of calls the body stands for, e.g. the number of samples drawn
+class section():
+
+	def __init__(self, name, n=1):
+		self.name = name
+		self.n = n
+
+	def __enter__(self):
+		if enabled:
+			self.t_start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		if enabled:
+			add(self.name, time.perf_counter() - self.t_start, self.n)
+		return False
+
+
+# Wrap a function (like a collision handler) so that its calls are timed as a section
+def timed(name, func):
+	def wrapper(*args, **kwargs):
+		t_start = time.perf_counter()
+		result = func(*args, **kwargs)
+		add(name, time.perf_counter() - t_start)
+		return result
+
+	return wrapper
+
+
+# Seconds left for the remaining items of a loop, given the time the done ones took
+def eta(done, total, t_start):
+	if done == 0:
+		return float('nan')
+
+	return (time.time() - t_start)/done*(total - done)
+
+
+# Timings per section and counts, plus steps per sample and samples per second
+def summary():
+	sections = {}
+	for name in sorted(calls):
+		sections[name] = {'seconds': seconds[name], 'calls': calls[name], 'mean_ms': 1000*seconds[name]/max(calls[name], 1)}
+
+	rates = {}
+	if seconds.get('sampling', 0) > 0:
+		rates['samples_per_second'] = calls['sampling']/seconds['sampling']
+	if counts.get('samples', 0) > 0:
+		rates['steps_per_sample'] = counts.get('steps', 0)/counts['samples']
+
+	return {'sections': sections, 'counts': dict(counts), 'rates': rates}
+
+
+# Print the sections, slowest first
+def report():
+	result = summary()
+	for name, entry in sorted(result['sections'].items(), key=lambda item: -item[1]['seconds']):
+		print('{:<20} {:>10.3f} s {:>10} calls'.format(name, entry['seconds'], entry['calls']))
+	for name, value in result['counts'].items():
+		print('{:<20} {:>10}'.format(name, value))
+	for name, value in result['rates'].items():
+		print('{:<20} {:>10.1f}'.format(name, value))
+
+
+# Save the summary and the grid search records as json, or as csv files
+# A csv holds one row per section, count and rate, the records go to a second csv with the suffix _cells
+def save(path):
+	result = summary()
+
+	if path.endswith('.json'):
+		result['records'] = records
+		with open(path, 'w') as f:
+			json.dump(result, f, indent=1)
+		return
+
+	with open(path, 'w', newline='') as f:
+		writer = csv.writer(f)
+		writer.writerow(['name', 'seconds', 'calls'])
+		for name, entry in result['sections'].items():
+			writer.writerow([name, entry['seconds'], entry['calls']])
+		for name, value in result['counts'].items():
+			writer.writerow([name, '', value])
+		for name, value in result['rates'].items():
+			writer.writerow([name, value, ''])
+
+	if len(records) > 0:
+		stem, extension = os.path.splitext(path)
+		with open(stem + '_cells' + extension, 'w', newline='') as f:
+			writer = csv.DictWriter(f, fieldnames=list(records[0].keys()))
+			writer.writeheader()
+			writer.writerows(records)
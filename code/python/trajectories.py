@@ -0,0 +1,188 @@
+# Recording and storing the trajectories of simulated samples
+# A TrajectoryRecorder is passed to a world in place of a renderer (see render.py): World.run
+# calls its draw() before every step and close() at the end of every sample. It writes the
+# state of every non-static body into float32 chunks of a TrajectoryStore, one row per step.
+# Chunks are .npy files created with open_memmap and written as the samples run, so only the
+# pages of the current chunk are held in memory. When a chunk is full it is flushed and its
+# samples are appended to the index of the store, one json line per sample.
+# Chunks are read memory-mapped, so stores larger than memory can be analysed or replayed
+# without simulating again.
+
+import model
+import numpy as np
+import pymunk
+import json
+import math
+import os
+import re
+
+# The columns of the state of a body in every recorded step
+columns = ['x', 'y', 'vx', 'vy', 'angle', 'angular_velocity']
+
+
+# Records num_samples samples, one after the other, into chunks of a store
+# Every chunk is a (samples, steps, bodies, columns) array of up to chunk_size samples.
+# meta (trial, condition, parameters, seed, ...) is added to the index entry of every sample,
+# along with its number in the batch (sample) and its coarse outcome if the world decided one.
+# The recording of a sample starts at the step its world is run from, which is the fork step
+# for samples forked from a snapshot. Steps after the end of a sample are left unwritten.
+class TrajectoryRecorder():
+
+	def __init__(self, store, num_samples, meta, chunk_size=100, step_max=700/model.speed_multiplier):
+		self.store = store
+		self.meta = meta
+		self.num_steps = math.floor(step_max) + 2
+		self.num_samples = num_samples
+		self.chunk_size = chunk_size
+		self.bodies = None
+		self.sample = 0
+		self.start_chunk()
+
+	# Start recording the next chunk, its file is created by the first draw()
+	def start_chunk(self):
+		self.data = None
+		self.chunk = None
+		self.first_sample = self.sample
+		self.rows = min(self.chunk_size, self.num_samples - self.sample)
+		self.start_steps = np.zeros(self.rows, dtype=np.int32)
+		self.lengths = np.zeros(self.rows, dtype=np.int32)
+		self.outcomes = [None]*self.rows
+
+	def draw(self, world):
+		if self.sample >= self.num_samples:
+			raise Exception('The recorder is full after', self.num_samples, 'samples')
+
+		if self.data is None:
+			if self.bodies is None:
+				self.bodies = [name for name, body in world.bodies.items() if body.body_type != pymunk.Body.STATIC]
+			self.chunk, self.data = self.store.new_chunk((self.rows, self.num_steps, len(self.bodies), len(columns)))
+
+		row_index = self.sample % self.chunk_size
+		if self.lengths[row_index] == 0:
+			self.start_steps[row_index] = world.step
+		self.world = world
+
+		row = self.data[row_index, self.lengths[row_index]]
+		for i, name in enumerate(self.bodies):
+			body = world.bodies[name]
+			row[i] = (body.position[0], body.position[1], body.velocity[0], body.velocity[1], body.angle, body.angular_velocity)
+		self.lengths[row_index] += 1
+
+	# The sample is done, the next draw() starts recording the next one
+	# A full chunk (or the chunk of the last sample) is flushed and added to the index of the store
+	def close(self):
+		row_index = self.sample % self.chunk_size
+		if self.world.events['outcome'] is not None:
+			self.outcomes[row_index] = self.world.events['outcome']['outcome_coarse']
+		self.sample += 1
+
+		if row_index + 1 == self.rows:
+			self.data.flush()
+			self.store.add_samples(self.chunk, self, self.outcomes)
+			self.data = None
+			if self.sample < self.num_samples:
+				self.start_chunk()
+
+
+# Trajectories on disk in the directory path
+# Every chunk is a chunk_<n>.npy file, and every sample of a finished chunk has a line in index.jsonl.
+# The index is kept in memory. Before it is used or appended to, only the lines added since it was
+# last read (by this or any other store on the same directory) are read, so several processes can
+# append to a store at once. Chunk files are created exclusively, so they never share a number.
+class TrajectoryStore():
+
+	def __init__(self, path):
+		self.path = path
+		os.makedirs(path, exist_ok=True)
+		self.index_file = os.path.join(path, 'index.jsonl')
+		self.chunks = {}
+		self.entries = []
+		self.index_offset = 0
+		self.refresh()
+
+		numbers = [int(m.group(1)) for m in map(re.compile(r'chunk_(\d+)\.npy$').match, os.listdir(path)) if m]
+		self.next_chunk = 1 + max(numbers + [entry['chunk'] for entry in self.entries], default=-1)
+
+	def chunk_file(self, chunk):
+		return os.path.join(self.path, 'chunk_{:05}.npy'.format(chunk))
+
+	# Read the lines added to the index file since it was last read
+	# A line that is still being written (without its newline) is left for the next read
+	def refresh(self):
+		if not os.path.exists(self.index_file):
+			return
+
+		with open(self.index_file, 'rb') as f:
+			f.seek(self.index_offset)
+			data = f.read()
+
+		complete = data[:data.rfind(b'\n') + 1]
+		self.entries.extend(json.loads(line) for line in complete.splitlines())
+		self.index_offset += len(complete)
+
+	# The index entries of all samples in the store
+	def index(self):
+		self.refresh()
+		return self.entries
+
+	# Create the file of a new chunk of the given shape, returns its number and the memory-mapped array
+	# The number is claimed by creating the file exclusively, taking the next one if another store has it
+	def new_chunk(self, shape):
+		while True:
+			chunk = self.next_chunk
+			self.next_chunk += 1
+			try:
+				os.close(os.open(self.chunk_file(chunk), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+				break
+			except FileExistsError:
+				continue
+
+		return chunk, np.lib.format.open_memmap(self.chunk_file(chunk), mode='w+', dtype=np.float32, shape=shape)
+
+	# Add the samples of a finished chunk of a recorder to the index
+	# outcomes optionally holds the coarse outcome of every sample
+	# The lines are appended in a single write, so that lines of other stores are not interleaved with them
+	def add_samples(self, chunk, recorder, outcomes=None):
+		entries = []
+		for i in range(len(recorder.lengths)):
+			entry = dict(recorder.meta)
+			entry.update({'chunk': chunk, 'row': i, 'sample': recorder.first_sample + i, 'start_step': int(recorder.start_steps[i]),
+				'length': int(recorder.lengths[i]), 'bodies': recorder.bodies})
+			if outcomes is not None and outcomes[i] is not None:
+				entry['outcome'] = int(outcomes[i])
+			entries.append(entry)
+
+		self.refresh()
+		with open(self.index_file, 'a') as f:
+			f.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+		self.refresh()
+
+	# The index entries whose fields match all given values, e.g. select(trial=0, condition='hypothetical')
+	def select(self, **fields):
+		return [entry for entry in self.index() if all(entry.get(key) == value for key, value in fields.items())]
+
+	# The recorded (steps, bodies, columns) array of a sample, memory-mapped from its chunk
+	def trajectory(self, entry):
+		if entry['chunk'] not in self.chunks:
+			self.chunks[entry['chunk']] = np.load(self.chunk_file(entry['chunk']), mmap_mode='r')
+
+		return self.chunks[entry['chunk']][entry['row'], :entry['length']]
+
+	# Iterate over the entries and trajectories of the selected samples, one at a time
+	def trajectories(self, **fields):
+		for entry in self.select(**fields):
+			yield entry, self.trajectory(entry)
+
+
+# Simulate num_samples removed-cause samples of a trial and append their trajectories to a store
+# Samples are drawn as a SamplePlan from seed, so the sample of an index entry is reproducible
+# from its seed and sample number
+def record_samples(store, trial, condition, num_samples, ball_noise=0.6, brick_noise=175, seed=0, fork=True, chunk_size=100):
+	collision_time = model.actual_world(trial)['collision_time']
+	snapshot = model.removed_prefix(trial, collision_time) if fork else None
+	plan = model.SamplePlan(trial, condition, num_samples, ball_noise, brick_noise, collision_time, np.random.default_rng(seed))
+
+	meta = {'trial': trial['trial'], 'condition': condition, 'ball_noise': ball_noise, 'brick_noise': brick_noise, 'seed': seed}
+	recorder = TrajectoryRecorder(store, num_samples, meta, chunk_size=chunk_size)
+	return [model.run_removed(trial, ball_noise=ball_noise, collision_time=collision_time, brick_noise=brick_noise,
+		cond=condition, snapshot=snapshot, plan=plan, index=i, recorder=recorder) for i in range(num_samples)]